@@ -1,5 +1,5 @@
-# Displays encoder counts on the screen and blinks the yellow LED with
-# each tick.
+# Displays encoder counts and speeds on the screen and blinks the yellow
+# LED with each tick.
 
 from zumo_2040_robot import robot
 
@@ -10,14 +10,17 @@ buttonB = robot.ButtonB()
 
 while True:
     c = encoders.get_counts()
+    s = encoders.get_speeds()
 
     # change LED on every count
     led((c[0] + c[1]) % 2)
 
-    display.fill_rect(0, 0, 128, 18, 0)
+    display.fill_rect(0, 0, 128, 50, 0)
     display.text("Left: "+str(c[0]), 0, 0)
     display.text("Right: "+str(c[1]), 0, 10)
-    display.text("Press B to reset", 0, 30)
+    display.text("Speeds (counts/s):", 0, 30)
+    display.text(f"{s[0]:>6} {s[1]:>6}", 0, 40)
+    display.text("Press B to reset", 0, 56)
     display.show()
 
     if buttonB.check():
@@ -94,12 +94,14 @@ draw_text()
 display.show()
 
 while True:
-    # Read the proximity sensors.
+    # Finish reading the proximity sensors.  Each reading is started as soon
+    # as the previous one is used, so it runs while the display updates.
     proximity_sensors.read()
     reading_left = proximity_sensors.left_counts_with_left_leds()
     reading_front_left = proximity_sensors.front_counts_with_left_leds()
     reading_front_right = proximity_sensors.front_counts_with_right_leds()
     reading_right = proximity_sensors.right_counts_with_right_leds()
+    proximity_sensors.start_read()
 
     # If the user presses button A, toggle whether the motors are on.
     if button_a.check() == True:
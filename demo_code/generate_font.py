@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 # Generates a C source file with font data in the ideal layout for writing to
-# an SH1106 OLED.
+# an SH1106 OLED, and a binary file with the same data for
+# zumo_2040_robot/font.py.
 #
 # Example usage:
 #
@@ -49,7 +50,7 @@ def read_hex(filename, width, height):
             font[codepoint] = parts[1]
     return font
 
-def print_glyph_bytes(font, codepoint, *, file):
+def glyph_bytes(font, codepoint):
     # Convert rows to columns.
     row_data = bytearray.fromhex(font[codepoint])
     column_data = [0] * font['width']
@@ -57,14 +58,19 @@ def print_glyph_bytes(font, codepoint, *, file):
         for column in range(0, 8):
             if row_data[row] >> (7 - column) & 1: column_data[column] |= (1 << row)
 
+    entries = []
     y = 0
     while y < font['height']:
         x = 0
         while x < font['width']:
-            entry = column_data[x] >> y & 0xFF
-            print("  0b{:08b},".format(entry), file=file)
+            entries.append(column_data[x] >> y & 0xFF)
             x += 1
         y += 8
+    return entries
+
+def print_glyph_bytes(font, codepoint, *, file):
+    for entry in glyph_bytes(font, codepoint):
+        print("  0b{:08b},".format(entry), file=file)
 
 def generate_u32(output, value, comment):
     print("  0x{:02x}, 0x{:02x}, 0x{:02x}, 0x{:02x},  // 0x{:08x}: {}".format(
@@ -72,19 +78,27 @@ def generate_u32(output, value, comment):
         value >> 16 & 0xFF, value >> 24 & 0xFF, value, comment
     ), file=output)
 
-def generate_c(font, filename):
+def font_codepoints(font):
     codepoints = sorted(set(desired_codepoints))
     for codepoint in list(codepoints):
         if codepoint not in font:
             print("Warning: Cannot find {} ({}) in {}, skipping.".
                 format(font['file'], description(codepoint), codepoint))
             codepoints.remove(codepoint)
+    return codepoints
 
+def font_layout(font):
+    # Returns the codepoints and the sizes that go in the font's header.
+    codepoints = font_codepoints(font)
     header_size = 16
     glyph_size = font['height'] // 8 * font['width']
     font_size = header_size + len(codepoints) * (4 + glyph_size)
     search_mask = 1
     while search_mask <= len(codepoints): search_mask <<= 1
+    return codepoints, glyph_size, font_size, search_mask
+
+def generate_c(font, filename):
+    codepoints, glyph_size, font_size, search_mask = font_layout(font)
 
     input_name = os.path.basename(font['file'])
     array_name = os.path.basename(filename).split(".")[0]
@@ -112,5 +126,27 @@ def generate_c(font, filename):
 
         print("};", file=output)
 
-generate_c(read_hex('unscii-16.hex', 8, 16), 'c/pololu_zumo_2040_robot/font_8x16.c')
-generate_c(read_hex('unscii-8.hex', 8, 8), 'c/pololu_zumo_2040_robot/font_8x8.c')
+def generate_bin(font, filename):
+    # The same layout as generate_c(), little-endian.
+    codepoints, glyph_size, font_size, search_mask = font_layout(font)
+
+    data = bytearray()
+    for value in (font_size, len(codepoints), search_mask):
+        data += value.to_bytes(4, 'little')
+    data += bytes([glyph_size, font['width'], font['height'], 0])
+    for codepoint in codepoints:
+        data += codepoint.to_bytes(4, 'little')
+    for codepoint in codepoints:
+        data += bytes(glyph_bytes(font, codepoint))
+
+    print("Generating {}...".format(filename))
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, mode="wb") as output:
+        output.write(data)
+
+font_8x16 = read_hex('unscii-16.hex', 8, 16)
+font_8x8 = read_hex('unscii-8.hex', 8, 8)
+generate_bin(font_8x16, 'zumo_2040_robot/fonts/font_8x16.bin')
+generate_bin(font_8x8, 'zumo_2040_robot/fonts/font_8x8.bin')
+generate_c(font_8x16, 'c/pololu_zumo_2040_robot/font_8x16.c')
+generate_c(font_8x8, 'c/pololu_zumo_2040_robot/font_8x8.c')
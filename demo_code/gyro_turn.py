@@ -1,10 +1,11 @@
 # This example make the robot turn 90 degrees using the gyroscope.
 #
-# If you need the turn to be more accurate, you might consider calibrating the
-# gyro (see rotation_resist.py), but that doesn't make much difference for
-# short turns.
+# With auto_zero on, the gyro's bias is estimated whenever the robot is still
+# and subtracted by convert_fifo(), so the angle drifts less if you leave the
+# robot still for a moment after starting it.
 
 from zumo_2040_robot import robot
+from array import array
 import time
 
 angle_to_turn = 90
@@ -16,12 +17,23 @@ button_c = robot.ButtonC()
 display = robot.Display()
 yellow_led = robot.YellowLED()
 
+# Only send the parts of the display that change, such as the digits of
+# the angle.
+display.enable_shadow()
+
 display.fill(0)
 display.text("Starting IMU...", 0, 0, 1)
 display.show()
 imu = robot.IMU()
 imu.reset()
 imu.enable_default()
+imu.gyro.auto_zero = True
+
+# Batch gyro readings in the IMU's FIFO so none are missed while the display
+# is updating.
+imu.gyro.enable_fifo(208)
+gyro_data = array('h', [0] * 3 * 16)
+gyro_times = array('i', [0] * 16)
 
 max_speed = 6000
 kp = 350
@@ -46,7 +58,7 @@ def draw_text():
 
 def handle_turn_or_stop(button, angle):
     global target_angle, drive_motors
-    global last_time_far_from_target, last_time_gyro_reading
+    global last_time_far_from_target
     target_angle = robot_angle + angle
     drive_motors = not drive_motors
     if drive_motors:
@@ -58,17 +70,16 @@ def handle_turn_or_stop(button, angle):
         time.sleep_ms(500)
         last_time_far_from_target = time.ticks_ms()
     draw_text()
-    last_time_gyro_reading = time.ticks_us()
 
 draw_text()
 
 while True:
-    # Update the angle and the turn rate.
-    if imu.gyro.data_ready():
-        imu.gyro.read()
-        turn_rate = imu.gyro.last_reading_dps[2]  # degrees per second
-        now = time.ticks_us()
-        if last_time_gyro_reading:
+    # Update the angle and the turn rate from each reading in the FIFO,
+    # using the IMU's timestamps.
+    for i in range(imu.gyro.read_fifo(gyro_data, gyro_times)):
+        turn_rate = imu.gyro.convert_fifo(gyro_data, i)[2]  # degrees per second
+        now = gyro_times[i]
+        if last_time_gyro_reading is not None:
             dt = time.ticks_diff(now, last_time_gyro_reading)
             robot_angle += turn_rate * dt / 1000000
         last_time_gyro_reading = now
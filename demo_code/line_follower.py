@@ -4,6 +4,9 @@
 # again to start it following the line.  You can also press A later
 # to stop the motors.
 #
+# The calibration is saved to flash, so on later runs you can press C
+# instead of A to skip calibrating.
+#
 # This demo shows how to use the _thread library to run a fast main
 # loop on one core of the RP2040.  The other core is free to run
 # slower functions like updating the display without impacting the
@@ -20,6 +23,7 @@ line_sensors = robot.LineSensors()
 # Note: It's not safe to use Button B in a
 # multi-core program.
 button_a = robot.ButtonA()
+button_c = robot.ButtonC()
 
 max_speed = 6000
 calibration_speed = 3000
@@ -30,34 +34,44 @@ display.text("Line Follower", 0, 0)
 display.text("Place on line", 0, 20)
 display.text("and press A to", 0, 30)
 display.text("calibrate.", 0, 40)
+have_saved_calibration = line_sensors.load_calibration()
+if have_saved_calibration:
+    display.text("C: use saved", 0, 50)
 display.show()
 
+calibrate = True
 while not button_a.check():
-    pass
+    if have_saved_calibration and button_c.check():
+        calibrate = False
+        break
 
 display.fill(0)
 display.show()
 time.sleep_ms(500)
 
-motors.set_speeds(calibration_speed, -calibration_speed)
-for i in range(calibration_count/4):
-    line_sensors.calibrate()
+if calibrate:
+    line_sensors.reset_calibration()
+
+    motors.set_speeds(calibration_speed, -calibration_speed)
+    for i in range(calibration_count/4):
+        line_sensors.calibrate()
 
-motors.off()
-time.sleep_ms(200)
+    motors.off()
+    time.sleep_ms(200)
 
-motors.set_speeds(-calibration_speed, calibration_speed)
-for i in range(calibration_count/2):
-    line_sensors.calibrate()
+    motors.set_speeds(-calibration_speed, calibration_speed)
+    for i in range(calibration_count/2):
+        line_sensors.calibrate()
 
-motors.off()
-time.sleep_ms(200)
+    motors.off()
+    time.sleep_ms(200)
 
-motors.set_speeds(calibration_speed, -calibration_speed)
-for i in range(calibration_count/4):
-    line_sensors.calibrate()
+    motors.set_speeds(calibration_speed, -calibration_speed)
+    for i in range(calibration_count/4):
+        line_sensors.calibrate()
 
-motors.off()
+    motors.off()
+    line_sensors.save_calibration()
 
 t1 = 0
 t2 = time.ticks_us()
@@ -28,7 +28,7 @@ while True:
     ]
 
     if proximity_sensors.total_counts() > 0:
-        angle_estimate = proximity_sensors.angle_estimate()
+        angle_estimate = proximity_sensors.angle_estimate(1)
         display.text(str(angle_estimate), 0, 10)
 
         dx = round(25 * math.sin(angle_estimate * math.pi / 180))
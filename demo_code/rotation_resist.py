@@ -1,9 +1,9 @@
 # This demo shows how the Zumo can use its gyroscope to detect when it is being
 # rotated, and use the motors to resist that rotation.
 #
-# Do not move the robot while it says "Calibrating..." on the screen.
-#
-# After the calibration is done, press button A to start the motors.
+# With auto_zero on, the gyro measures its own bias whenever the robot is
+# still, so leave it still for a moment before pressing button A to start the
+# motors.
 # If you try to turn the Zumo, or put it on a surface that is turning, it will
 # drive its motors to counteract the turning.  This demo only uses the Z axis
 # of the gyro, so it is possible to pick up the Zumo, rotate it about its X
@@ -26,24 +26,15 @@ display.show()
 imu = robot.IMU()
 imu.reset()
 imu.enable_default()
+imu.gyro.auto_zero = True
 
 max_speed = 6000
 kp = 350
 kd = 7
 
-display.fill(0)
-display.text("Calibrating...", 0, 0, 1)
-display.show()
-time.sleep_ms(500)
-calibration_start = time.ticks_ms()
-stationary_gz = 0.0
-reading_count = 0
-while time.ticks_diff(time.ticks_ms(), calibration_start) < 1000:
-    if imu.gyro.data_ready():
-        imu.gyro.read()
-        stationary_gz += imu.gyro.last_reading_dps[2]
-        reading_count += 1
-stationary_gz /= reading_count
+# Read the gyro in the background, recording when each reading arrives.
+imu.start_sampling()
+gyro_count = imu.gyro_times.count
 
 drive_motors = False
 last_time_gyro_reading = None
@@ -62,10 +53,10 @@ draw_text()
 
 while True:
     # Update the angle and the turn rate.
-    if imu.gyro.data_ready():
-        imu.gyro.read()
-        turn_rate = imu.gyro.last_reading_dps[2] - stationary_gz  # degrees per second
-        now = time.ticks_us()
+    if imu.gyro_times.count != gyro_count:
+        gyro_count = imu.gyro_times.count
+        turn_rate = imu.gyro.last_reading_dps[2]  # degrees per second
+        now = imu.gyro_times.last_time()
         if last_time_gyro_reading:
             dt = time.ticks_diff(now, last_time_gyro_reading)
             robot_angle += turn_rate * dt / 1000000
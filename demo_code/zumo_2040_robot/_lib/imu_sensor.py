@@ -1,11 +1,12 @@
 import array
-import struct
 
 class IMUSensor:
     def __init__(self, i2c, addr):
         self.i2c = i2c
         self.addr = addr
+        # Every read overwrites this buffer in place.
         self._buf = array.array('h', [0, 0, 0])
+        self.last_reading_raw = self._buf
 
     def _read_reg(self, reg):
         return self.i2c.readfrom_mem(self.addr, reg, 1)[0]
@@ -17,5 +18,27 @@ class IMUSensor:
         self._write_reg(reg, (self._read_reg(reg) & ~mask) | (val & mask))
 
     def _read_axes_s16(self, first_reg):
+        # The axes are little-endian like the RP2040, so they can be read
+        # straight into the array('h'), which is returned to avoid
+        # allocating.
         self.i2c.readfrom_mem_into(self.addr, first_reg, self._buf)
-        return list(struct.unpack('<3h', self._buf))
\ No newline at end of file
+        return self._buf
+
+    def _to_fixed(self, out, num, shift):
+        # Scales the last raw reading into out as integers, without floats.
+        _scale_axes(self._buf, 0, self._buf, out, num, shift)
+        return out
+
+@micropython.viper
+def _scale_axes(raw, first: int, buf, out, num: int, shift: int):
+    # Copies three axes from raw, starting at first, into buf, and scales
+    # them into out as (axis * num) >> shift.
+    src = ptr16(raw)
+    dst = ptr16(buf)
+    o = ptr32(out)
+    for i in range(3):
+        v = int(src[first + i])
+        if v & 0x8000:
+            v -= 0x10000
+        dst[i] = v
+        o[i] = (v * num) >> shift
\ No newline at end of file
@@ -1,4 +1,6 @@
 from . import imu_sensor
+import array
+import math
 
 _DEFAULT_ADDR = 0b0011110
 
@@ -22,6 +24,14 @@ _output_data_rate_encoding = {
     40:    0b110,
     80:    0b111}
 
+# With CTRL_REG1.FAST_ODR = 1, the output data rate depends on the operating
+# mode (CTRL_REG1.OM and CTRL_REG4.OMZ) instead.
+_fast_odr_operating_mode = {
+    155:  0b11,
+    300:  0b10,
+    560:  0b01,
+    1000: 0b00}
+
 # encodings for CTRL_REG2.FS
 _full_scale_encoding = {
     4:  0b00,
@@ -36,9 +46,20 @@ _full_scale_to_sensitivity = {
     12: 2281,
     16: 1711}
 
+CALIBRATION_FILE = "magnetometer.cal"
+CALIBRATION_SAMPLES = 400
+
 class LIS3MDL(imu_sensor.IMUSensor):
     def __init__(self, i2c):
         self.last_reading_gauss = [None, None, None]
+
+        # Readings are corrected to soft_iron * (gauss - hard_iron), with
+        # soft_iron a 3x3 matrix in row order.
+        self.hard_iron = array.array('f', [0, 0, 0])
+        self.soft_iron = array.array('f', [1, 0, 0, 0, 1, 0, 0, 0, 1])
+        self._cal_samples = array.array('f', [0] * (2 * CALIBRATION_SAMPLES))
+        self._cal_count = 0
+        self.last_reading_mgauss = array.array('i', [0, 0, 0])
         super().__init__(i2c, _DEFAULT_ADDR)
 
     def detect(self):
@@ -67,19 +88,33 @@ class LIS3MDL(imu_sensor.IMUSensor):
         self._write_reg_masked(_CTRL_REG4, 0x0C, 0x0C)
 
     def set_output_data_rate(self, hz):
-        # note: this method doesn't support CTRL_REG1.FAST_ODR = 1 (ODR > 80 Hz)
+        # Rates above 80 Hz use CTRL_REG1.FAST_ODR, which trades noise for
+        # speed by leaving ultra-high-performance mode.
+        if hz in _fast_odr_operating_mode:
+            om = _fast_odr_operating_mode[hz]
+            # CTRL_REG1.OM = om, FAST_ODR = 1
+            self._write_reg_masked(_CTRL_REG1, om << 5 | 0x02, 0x62)
+            # CTRL_REG4.OMZ = om
+            self._write_reg_masked(_CTRL_REG4, om << 2, 0x0C)
+            self.output_data_rate = hz
+            return
+
         try:
             do = _output_data_rate_encoding[hz]
         except KeyError:
             raise ValueError(f"Invalid output data rate: {hz}")
 
-        # CTRL_REG1.DO = do
-        self._write_reg_masked(_CTRL_REG1, do << 2, 0x1C)
+        # CTRL_REG1.OM = 11, FAST_ODR = 0, DO = do
+        self._write_reg_masked(_CTRL_REG1, 0x60 | do << 2, 0x7E)
+        # CTRL_REG4.OMZ = 11
+        self._write_reg_masked(_CTRL_REG4, 0x0C, 0x0C)
+        self.output_data_rate = hz
 
     def set_full_scale(self, gauss):
         try:
             fs = _full_scale_encoding[gauss]
             self._sensitivity = _full_scale_to_sensitivity[gauss]
+            self._mgauss_num = round((1000 << 16) / self._sensitivity)
         except KeyError:
             raise ValueError(f"Invalid full scale: {gauss}")
 
@@ -105,5 +140,127 @@ class LIS3MDL(imu_sensor.IMUSensor):
         self.last_reading_raw = self._read_axes_s16(_OUT_X_L)
         # Updating the converted readings in-place is more memory-efficient than
         # using to_gauss():
+        g = self.last_reading_gauss
+        h = self.hard_iron
         for i in range(3):
-            self.last_reading_gauss[i] = self.axis_to_gauss(self.last_reading_raw[i])
+            g[i] = self.axis_to_gauss(self.last_reading_raw[i]) - h[i]
+        s = self.soft_iron
+        x, y, z = g
+        for i in range(3):
+            g[i] = s[3 * i] * x + s[3 * i + 1] * y + s[3 * i + 2] * z
+
+    def reset_calibration(self):
+        self.hard_iron = array.array('f', [0, 0, 0])
+        self.soft_iron = array.array('f', [1, 0, 0, 0, 1, 0, 0, 0, 1])
+        self._cal_count = 0
+
+    def add_calibration_sample(self):
+        # Records the x and y axes of the last reading while the robot spins
+        # flat.  Returns False once there is no room for more samples.
+        if self._cal_count >= CALIBRATION_SAMPLES:
+            return False
+        raw = self.last_reading_raw
+        i = 2 * self._cal_count
+        self._cal_samples[i] = self.axis_to_gauss(raw[0])
+        self._cal_samples[i + 1] = self.axis_to_gauss(raw[1])
+        self._cal_count += 1
+        return True
+
+    def fit_calibration(self):
+        # Fits an ellipse to the samples and sets hard_iron and soft_iron to
+        # map it to a circle of the same area.  Spinning flat only shows the
+        # x and y axes, so z is left uncorrected.  Returns False if the
+        # samples do not make an ellipse.
+        n = self._cal_count
+        samples = self._cal_samples
+        if n < 10:
+            return False
+
+        # Shift to the middle of the samples so the fit is well conditioned.
+        x0 = (max(samples[0:2 * n:2]) + min(samples[0:2 * n:2])) / 2
+        y0 = (max(samples[1:2 * n:2]) + min(samples[1:2 * n:2])) / 2
+
+        # Least squares for a x^2 + b xy + c y^2 + d x + e y = 1.
+        m = [[0.0] * 6 for _ in range(5)]
+        for k in range(n):
+            x = samples[2 * k] - x0
+            y = samples[2 * k + 1] - y0
+            row = (x * x, x * y, y * y, x, y)
+            for i in range(5):
+                for j in range(5):
+                    m[i][j] += row[i] * row[j]
+                m[i][5] += row[i]
+        p = _solve(m)
+        if p is None:
+            return False
+        a, b, c, d, e = p
+
+        # The center solves [2a b; b 2c] [cx cy] = -[d e].
+        det = 4 * a * c - b * b
+        if det <= 0:
+            return False
+        cx = (-2 * c * d + b * e) / det
+        cy = (b * d - 2 * a * e) / det
+
+        # Around the center, [x y] Q [x y]' = k with Q = [a b/2; b/2 c].
+        k = 1 + a * cx * cx + b * cx * cy + c * cy * cy
+        qa, qb, qc = a / k, b / 2 / k, c / k
+
+        # sqrt(Q) maps the ellipse to the unit circle; scale it by the
+        # geometric mean radius to keep the readings in gauss.
+        s = math.sqrt(qa * qc - qb * qb)
+        t = math.sqrt(qa + qc + 2 * s)
+        r = 1 / math.sqrt(s)
+        self.hard_iron = array.array('f', [x0 + cx, y0 + cy, 0])
+        self.soft_iron = array.array('f', [
+            (qa + s) / t * r, qb / t * r, 0,
+            qb / t * r, (qc + s) / t * r, 0,
+            0, 0, 1])
+        return True
+
+    def save_calibration(self, filename=CALIBRATION_FILE):
+        with open(filename, 'wb') as f:
+            f.write(self.hard_iron)
+            f.write(self.soft_iron)
+
+    def load_calibration(self, filename=CALIBRATION_FILE):
+        # Returns True if a complete calibration was loaded.
+        hard_iron = array.array('f', [0] * 3)
+        soft_iron = array.array('f', [0] * 9)
+        try:
+            with open(filename, 'rb') as f:
+                if f.readinto(hard_iron) != 12 or f.readinto(soft_iron) != 36:
+                    return False
+        except OSError:
+            return False
+        self.hard_iron = hard_iron
+        self.soft_iron = soft_iron
+        return True
+
+    def read_raw(self):
+        # Returns the sensor's own array('h') buffer, which the next reading
+        # overwrites (it is also last_reading_raw), so copy it to keep it.
+        return self._read_axes_s16(_OUT_X_L)
+
+    def read_mgauss(self):
+        # Reads into last_reading_mgauss as integer milligauss.
+        self._read_axes_s16(_OUT_X_L)
+        return self._to_fixed(self.last_reading_mgauss, self._mgauss_num, 16)
+
+def _solve(m):
+    # Solves the augmented n x (n+1) matrix m in place by Gaussian
+    # elimination with partial pivoting.
+    n = len(m)
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(m[r][i]))
+        if abs(m[pivot][i]) < 1e-12:
+            return None
+        m[i], m[pivot] = m[pivot], m[i]
+        for r in range(i + 1, n):
+            f = m[r][i] / m[i][i]
+            for j in range(i, n + 1):
+                m[r][j] -= f * m[i][j]
+    x = [0.0] * n
+    for i in range(n - 1, -1, -1):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+    return x
@@ -1,14 +1,56 @@
 from . import imu_sensor
+from micropython import const
+import array
 
 _DEFAULT_ADDR = 0b1101011
 
-_WHO_AM_I   = 0x0F
-_CTRL1_XL   = 0x10
-_CTRL2_G    = 0x11
-_CTRL3_C    = 0x12
-_STATUS_REG = 0x1E
-_OUTX_L_G   = 0x22
-_OUTX_L_XL  = 0x28
+_FIFO_CTRL3   = 0x09
+_FIFO_CTRL4   = 0x0A
+_COUNTER_BDR_REG1 = 0x0B
+_INT1_CTRL    = 0x0D
+_WHO_AM_I     = 0x0F
+_CTRL1_XL     = 0x10
+_CTRL2_G      = 0x11
+_CTRL3_C      = 0x12
+_CTRL10_C     = 0x19
+_STATUS_REG   = 0x1E
+_OUTX_L_G     = 0x22
+_OUTX_L_XL    = 0x28
+_FIFO_STATUS1 = 0x3A
+_FIFO_DATA_OUT_TAG = 0x78
+
+# FIFO_DATA_OUT_TAG.TAG_SENSOR values
+_TAG_GYRO      = const(0x01)
+_TAG_TIMESTAMP = const(0x04)
+
+# The robot is treated as still when the gyro and accelerometer readings vary
+# less than these (standard deviation) for at least _STILL_TIME seconds, and
+# the gyro's average reading is near the bias.  Until the bias has settled,
+# near means within _MAX_BIAS_DPS, a little more than the zero-rate level in
+# the datasheet; after that, within _NEAR_BIAS_DPS, a few times the noise,
+# so a slow steady rotation is not mistaken for bias.
+_STILL_DPS = 0.5
+_STILL_G = 0.01
+_STILL_TIME = 0.25
+_MAX_BIAS_DPS = 2
+_NEAR_BIAS_DPS = 0.2
+
+# While still, the bias is the average of up to this many readings, so it
+# settles quickly at first and then follows slow changes with temperature.
+# Once settled, each reading moves it by at most _BIAS_STEP_DPS.
+_BIAS_READINGS = const(512)
+_BIAS_STEP_DPS = 0.002
+
+# Each FIFO word is a tag byte and 6 data bytes.  Reading past the end of
+# FIFO_DATA_OUT rolls back to FIFO_DATA_OUT_TAG, so several words can be read
+# in one transaction.
+_FIFO_WORD_SIZE = const(7)
+_FIFO_BURST_WORDS = const(32)
+
+# The fixed-point readings are (raw * num) >> shift, with num worked out
+# from the sensitivity for each full scale.
+_MG_SHIFT = const(16)
+_MDPS_SHIFT = const(8)
 
 # encodings for CTRL1_XL.ODR_XL and CTRL2_G.ODR_G (high performance mode only)
 _output_data_rate_encoding = {
@@ -58,6 +100,7 @@ _gyro_full_scale_to_sensitivity = {
 class LSM6DSOAcc(imu_sensor.IMUSensor):
     def __init__(self, i2c, addr):
         self.last_reading_g = [None, None, None]
+        self.last_reading_mg = array.array('i', [0, 0, 0])
         super().__init__(i2c, addr)
 
     def set_output_data_rate(self, hz):
@@ -70,6 +113,7 @@ class LSM6DSOAcc(imu_sensor.IMUSensor):
 
         # CTRL1_XL.ODR_XL = odr_xl
         self._write_reg_masked(_CTRL1_XL, odr_xl << 4, 0xF0)
+        self.output_data_rate = hz
 
     def set_full_scale(self, g):
         # note: this method doesn't support CTRL8_XL.XL_FS_MODE = 1
@@ -77,6 +121,8 @@ class LSM6DSOAcc(imu_sensor.IMUSensor):
         try:
             fs_xl = _acc_full_scale_encoding[g]
             self._sensitivity = _acc_full_scale_to_sensitivity[g]
+            self._scale = self._sensitivity / 1000
+            self._mg_num = round(self._sensitivity * (1 << _MG_SHIFT))
         except KeyError:
             raise ValueError(f"Invalid full scale: {g}")
 
@@ -94,19 +140,58 @@ class LSM6DSOAcc(imu_sensor.IMUSensor):
     def axis_to_g(self, axis_raw):
         return axis_raw * self._sensitivity / 1000
 
+    def _convert(self, raw, first):
+        # Updates all the readings in place from three axes in raw.
+        imu_sensor._scale_axes(raw, first, self._buf, self.last_reading_mg,
+            self._mg_num, _MG_SHIFT)
+        raw = self._buf
+        scale = self._scale
+        for i in range(3):
+            self.last_reading_g[i] = raw[i] * scale
+
     def to_g(self, raw):
         return [self.axis_to_g(x) for x in raw]
 
     def read(self):
-        self.last_reading_raw = self._read_axes_s16(_OUTX_L_XL)
         # Updating the converted readings in-place is more memory-efficient than
         # using to_g():
-        for i in range(3):
-            self.last_reading_g[i] = self.axis_to_g(self.last_reading_raw[i])
+        self._convert(self._read_axes_s16(_OUTX_L_XL), 0)
+
+    def read_raw(self):
+        # Returns the sensor's own array('h') buffer, which the next reading
+        # overwrites (it is also last_reading_raw), so copy it to keep it.
+        return self._read_axes_s16(_OUTX_L_XL)
+
+    def read_mg(self):
+        # Reads into last_reading_mg as integer milli-g.
+        self._read_axes_s16(_OUTX_L_XL)
+        return self._to_fixed(self.last_reading_mg, self._mg_num, _MG_SHIFT)
 
 class LSM6DSOGyro(imu_sensor.IMUSensor):
     def __init__(self, i2c, addr):
         self.last_reading_dps = [None, None, None]
+        self.last_reading_mdps = array.array('i', [0, 0, 0])
+
+        # Gyro bias, subtracted from last_reading_dps and last_reading_mdps.
+        # Set auto_zero to True to estimate it whenever the robot is still.
+        self.auto_zero = False
+        self.bias_dps = [0.0, 0.0, 0.0]
+        self._acc = None
+        self._mean = [0.0, 0.0, 0.0]
+        self._var = 0.0
+        self._acc_mean = [0.0, 0.0, 0.0]
+        self._acc_var = 0.0
+        self._still_readings = 0
+        self._still_count = 0
+        self._bias_count = 0
+        self._fifo_buf = bytearray(_FIFO_WORD_SIZE * _FIFO_BURST_WORDS)
+        # A view of the buffer for each burst length, so read_fifo() does
+        # not allocate slices.
+        mv = memoryview(self._fifo_buf)
+        self._fifo_views = [mv[:n * _FIFO_WORD_SIZE] for n in range(_FIFO_BURST_WORDS + 1)]
+        self._fifo_status = bytearray(2)
+        self._fifo_count = 0
+        self._fifo_time = 0
         super().__init__(i2c, addr)
 
     def set_output_data_rate(self, hz):
@@ -119,11 +204,15 @@ class LSM6DSOGyro(imu_sensor.IMUSensor):
 
         # CTRL2_G.ODR_G = odr_g
         self._write_reg_masked(_CTRL2_G, odr_g << 4, 0xF0)
+        self.output_data_rate = hz
+        self._still_readings = int(hz * _STILL_TIME)
 
     def set_full_scale(self, dps):
         try:
             fs_g_fs_125 = _gyro_full_scale_encoding[dps]
             self._sensitivity = _gyro_full_scale_to_sensitivity[dps]
+            self._scale = self._sensitivity / 1000
+            self._mdps_num = round(self._sensitivity * (1 << _MDPS_SHIFT))
         except KeyError:
             raise ValueError(f"Invalid full scale: {dps}")
 
@@ -138,23 +227,184 @@ class LSM6DSOGyro(imu_sensor.IMUSensor):
         # STATUS_REG.GDA
         return bool(self._read_reg(_STATUS_REG) & 0x02)
 
+    def enable_data_ready_int1(self):
+        # COUNTER_BDR_REG1.dataready_pulsed = 1: a short pulse for each
+        # reading, so a missed read does not leave INT1 stuck high
+        self._write_reg_masked(_COUNTER_BDR_REG1, 0x80, 0x80)
+        # INT1_CTRL.INT1_DRDY_G = 1
+        self._write_reg_masked(_INT1_CTRL, 0x02, 0x02)
+
     def axis_to_dps(self, axis_raw):
         return axis_raw * self._sensitivity / 1000
 
+    def _convert(self, raw, first):
+        # Updates all the readings in place from three axes in raw, then
+        # estimates and subtracts the bias.
+        mdps = self.last_reading_mdps
+        imu_sensor._scale_axes(raw, first, self._buf, mdps, self._mdps_num,
+            _MDPS_SHIFT)
+        raw = self._buf
+        dps = self.last_reading_dps
+        scale = self._scale
+        for i in range(3):
+            dps[i] = raw[i] * scale
+        if self.auto_zero:
+            self._estimate_bias(dps)
+        for i in range(3):
+            dps[i] -= self.bias_dps[i]
+            mdps[i] -= int(self.bias_dps[i] * 1000)
+
+    def _estimate_bias(self, dps):
+        # Exponential moving averages of the readings and their variance.
+        settled = self._bias_count >= _BIAS_READINGS
+        near = _NEAR_BIAS_DPS if settled else _MAX_BIAS_DPS
+        var = 0
+        moving = False
+        for i in range(3):
+            d = dps[i] - self._mean[i]
+            self._mean[i] += d / 16
+            var += d * d
+            if abs(self._mean[i] - self.bias_dps[i]) > near:
+                moving = True
+        self._var += (var - self._var) / 16
+
+        # Use the accelerometer's last reading too, if it has one.
+        acc = self._acc.last_reading_g if self._acc else None
+        if acc and acc[0] is not None:
+            var = 0
+            for i in range(3):
+                d = acc[i] - self._acc_mean[i]
+                self._acc_mean[i] += d / 16
+                var += d * d
+            self._acc_var += (var - self._acc_var) / 16
+
+        if (moving or self._var > _STILL_DPS * _STILL_DPS
+                or self._acc_var > _STILL_G * _STILL_G):
+            self._still_count = 0
+            return
+        self._still_count += 1
+        if self._still_count < self._still_readings:
+            return
+
+        if not settled:
+            self._bias_count += 1
+        for i in range(3):
+            step = (dps[i] - self.bias_dps[i]) / self._bias_count
+            if settled:
+                step = max(-_BIAS_STEP_DPS, min(step, _BIAS_STEP_DPS))
+            self.bias_dps[i] += step
+
     def to_dps(self, raw):
         return [self.axis_to_dps(x) for x in raw]
 
     def read(self):
-        self.last_reading_raw = self._read_axes_s16(_OUTX_L_G)
         # Updating the converted readings in-place is more memory-efficient than
         # using to_dps():
+        self._convert(self._read_axes_s16(_OUTX_L_G), 0)
+
+    def read_raw(self):
+        # Returns the sensor's own array('h') buffer, which the next reading
+        # overwrites (it is also last_reading_raw), so copy it to keep it.
+        return self._read_axes_s16(_OUTX_L_G)
+
+    def read_mdps(self):
+        # Reads into last_reading_mdps as integer millidegrees per second,
+        # less the bias.  This does not update the bias estimate.
+        self._read_axes_s16(_OUTX_L_G)
+        mdps = self._to_fixed(self.last_reading_mdps, self._mdps_num,
+            _MDPS_SHIFT)
         for i in range(3):
-            self.last_reading_dps[i] = self.axis_to_dps(self.last_reading_raw[i])
+            mdps[i] -= int(self.bias_dps[i] * 1000)
+        return mdps
+
+    def enable_fifo(self, hz):
+        # Batches gyro readings into the FIFO at the given rate (normally the
+        # output data rate), each preceded by a timestamp.
+        try:
+            bdr_gy = _output_data_rate_encoding[hz]
+        except KeyError:
+            raise ValueError(f"Invalid batch data rate: {hz}")
+
+        # CTRL10_C.TIMESTAMP_EN = 1
+        self._write_reg_masked(_CTRL10_C, 0x20, 0x20)
+        # FIFO_CTRL3.BDR_GY = bdr_gy
+        self._write_reg_masked(_FIFO_CTRL3, bdr_gy << 4, 0xF0)
+        # FIFO_CTRL4.DEC_TS_BATCH = 01 (a timestamp with every batch),
+        # FIFO_MODE = 110 (continuous)
+        self._write_reg_masked(_FIFO_CTRL4, 0x46, 0xC7)
+
+    def disable_fifo(self):
+        # FIFO_CTRL4.FIFO_MODE = 000 (bypass), which also empties the FIFO
+        self._write_reg_masked(_FIFO_CTRL4, 0x00, 0x07)
+        # FIFO_CTRL3.BDR_GY = 0
+        self._write_reg_masked(_FIFO_CTRL3, 0x00, 0xF0)
+
+    def fifo_level(self):
+        # The number of words in the FIFO (FIFO_STATUS1/2.DIFF_FIFO), counting
+        # both readings and timestamps.
+        self.i2c.readfrom_mem_into(self.addr, _FIFO_STATUS1, self._fifo_status)
+        return self._fifo_status[0] | (self._fifo_status[1] & 0x03) << 8
+
+    def read_fifo(self, data, times):
+        # Drains raw gyro readings from the FIFO into data, an array('h')
+        # holding x, y and z for each reading (see convert_fifo()), and their
+        # timestamps in microseconds into times, an array('i').  The
+        # timestamps wrap like time.ticks_us(), so compare them with
+        # time.ticks_diff().  Returns the number of readings; any that did not
+        # fit stay in the FIFO.
+        capacity = len(times)
+        if len(data) < 3 * capacity:
+            capacity = len(data) // 3
+        views = self._fifo_views
+        self._fifo_count = 0
+        while self._fifo_count < capacity:
+            words = self.fifo_level()
+            if words == 0:
+                break
+            # Each reading takes two words, with its timestamp.
+            room = 2 * (capacity - self._fifo_count)
+            if words > room: words = room
+            if words > _FIFO_BURST_WORDS: words = _FIFO_BURST_WORDS
+            self.i2c.readfrom_mem_into(self.addr, _FIFO_DATA_OUT_TAG, views[words])
+            self._decode_fifo(words, data, times)
+        return self._fifo_count
+
+    def convert_fifo(self, data, i):
+        # Converts reading i from read_fifo() into last_reading_dps and
+        # last_reading_mdps, estimating and subtracting the bias like read()
+        # does.  Convert the readings in order so the bias estimate sees them
+        # as they arrived.
+        self._convert(data, 3 * i)
+        return self.last_reading_dps
+
+    @micropython.viper
+    def _decode_fifo(self, words: int, data, times):
+        buf = ptr8(self._fifo_buf)
+        out = ptr16(data)
+        t = ptr32(times)
+        count = int(self._fifo_count)
+        time = int(self._fifo_time)
+        for w in range(words):
+            p = w * _FIFO_WORD_SIZE
+            tag = buf[p] >> 3
+            if tag == _TAG_TIMESTAMP:
+                # TIMESTAMP0-3, with 25 us per LSB
+                ts = buf[p + 1] | buf[p + 2] << 8 | buf[p + 3] << 16 | buf[p + 4] << 24
+                time = (ts * 25) & 0x3fffffff
+            elif tag == _TAG_GYRO:
+                for i in range(3):
+                    out[count * 3 + i] = buf[p + 1 + 2 * i] | buf[p + 2 + 2 * i] << 8
+                t[count] = time
+                count += 1
+        self._fifo_count = count
+        self._fifo_time = time
 
 class LSM6DSO(imu_sensor.IMUSensor):
     def __init__(self, i2c):
         self.acc = LSM6DSOAcc(i2c, _DEFAULT_ADDR)
         self.gyro = LSM6DSOGyro(i2c, _DEFAULT_ADDR)
+        self.gyro._acc = self.acc
+        self._both_buf = array.array('h', [0] * 6)
         super().__init__(i2c, _DEFAULT_ADDR)
 
     @property
@@ -189,5 +439,9 @@ class LSM6DSO(imu_sensor.IMUSensor):
         self.gyro.enable_default()
 
     def read(self):
-        self.acc.read()
-        self.gyro.read()
+        # The gyro and accelerometer output registers are next to each other
+        # (OUTX_L_G to OUTZ_H_XL), so read them both in one transaction.  This
+        # fills the fixed-point readings too.
+        self.i2c.readfrom_mem_into(self.addr, _OUTX_L_G, self._both_buf)
+        self.acc._convert(self._both_buf, 3)
+        self.gyro._convert(self._both_buf, 0)
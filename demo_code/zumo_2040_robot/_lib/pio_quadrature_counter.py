@@ -1,81 +1,117 @@
 import machine
 import utime
 import rp2
-from machine import Pin
-import array
+from machine import Pin, mem32
+
+_PIO0_BASE = const(0x50200000)
+_FSTAT = const(0x004 >> 2)
+_TXF0 = const(0x010 >> 2)
+_RXF0 = const(0x020 >> 2)
+_RXEMPTY0 = const(1 << 8)
+_SM0_EXECCTRL = const(0xcc)
+
+# The program samples the pins once every 8 cycles, so at this rate the time
+# since the last edge is counted in microseconds.
+_PIO_FREQ = const(8000000)
 
 class PIOQuadratureCounter:
     """A quadrature encoder counter implemented in PIO"""
-    
-    @rp2.asm_pio(autopush=False, autopull=False)
-    
+
+    @rp2.asm_pio(autopush=True, push_thresh=32, autopull=False)
+
     def counter():
-        # From https://github.com/raspberrypi/pico-examples/blob/master/pio/quadrature_encoder/quadrature_encoder.pio
+        # Based on https://github.com/raspberrypi/pico-examples/blob/master/pio/quadrature_encoder/quadrature_encoder.pio
+        #
+        # Y holds the count and X counts down once per sample since the last
+        # edge.  OSR holds the inverted previous pins.  The jump table is in
+        # the upper half of the program, indexed by 1:~previous:current, so
+        # that "mov(pc, status)" can jump to 0 to report when the CPU has
+        # made a request and to 31 otherwise.
+
+        # Report the count and time to the CPU.  Each full "in" is pushed
+        # automatically, while sampling the pins never fills the ISR.
+        in_(y, 32)
+        in_(x, 32)
+        mov(isr, osr)
+        pull()           # consume the request
+        mov(osr, isr)
 
-        jmp("update")    # 00 -> 00
-        jmp("decrement") # 00 -> 01
-        jmp("increment") # 00 -> 10
-        jmp("update")    # 00 -> 11
-        
-        jmp("increment") # 01 -> 00
-        jmp("update")    # 01 -> 01
-        jmp("update")    # 01 -> 10
-        jmp("decrement") # 01 -> 11
-        
-        jmp("decrement") # 10 -> 00
-        jmp("update")    # 10 -> 01
-        jmp("update")    # 10 -> 10
-        jmp("increment") # 10 -> 11
-        
-        jmp("update")    # 11 -> 00
-        jmp("increment") # 11 -> 01
-        label("decrement")#11 -> 10
-        jmp(y_dec, "update")
-        label("update")  # 11 -> 11
-        
         wrap_target()
-        set(x, 0)
-        pull(noblock) # check for request
-        
-        mov(x, osr)
-        mov(osr, isr) # OSR = previous pins
-        jmp(not_x, "sample_pins")
-        
-        # report data
-        mov(isr, y)
-        push()
-        
         label("sample_pins")
-        mov(isr, null)
+        mov(isr, invert(null))
         in_(osr, 2)
         in_(pins, 2)
-        mov(pc, isr) # jump to <previous>:<current>
-        
+        mov(osr, invert(isr))
+        mov(pc, isr)     # jump to 1:~<previous>:<current>
+
         label("increment")
-        mov(x, invert(y))
-        jmp(x_dec, "increment2")
+        mov(y, invert(y))
+        jmp(y_dec, "increment2")
         label("increment2")
-        mov(y, invert(x))
-        wrap()
-        nop() # We have to fill up the program space or Micropython won't put it at the
-        nop() # beginning of the program, and the jump table doesn't work.
-        nop()
+        mov(y, invert(y))
+        jmp("edge")
+
+        label("decrement")
+        jmp(y_dec, "edge") # reaches edge whether or not y was 0
+        label("edge")
+        mov(x, null)
+
+        label("check")   # 11 -> 00
+        mov(pc, status)  # to 0 with a request, or to 31
+        jmp("increment") # 11 -> 01
+        jmp("decrement") # 11 -> 10
+        jmp("check")     # 11 -> 11
+
+        jmp("decrement") # 10 -> 00
+        jmp("check")     # 10 -> 01
+        jmp("check")     # 10 -> 10
+        jmp("increment") # 10 -> 11
+
+        jmp("increment") # 01 -> 00
+        jmp("check")     # 01 -> 01
+        jmp("check")     # 01 -> 10
+        jmp("decrement") # 01 -> 11
+
+        jmp("check")     # 00 -> 00
+        jmp("decrement") # 00 -> 01
+        jmp("increment") # 00 -> 10
+        jmp(x_dec, "sample_pins") # 00 -> 11, and the end of each loop
 
     def __init__(self, pio1, pin1, pin2):
         if pin2 != pin1 + 1:
             raise Exception("pin2 must be pin1 + 1")
-        
+
         Pin(pin1, Pin.IN, Pin.PULL_UP)
         Pin(pin2, Pin.IN, Pin.PULL_UP)
-        self.sm1 = rp2.StateMachine(pio1, self.counter, freq=125000000, in_base=machine.Pin(pin1))
+        self.sm1 = rp2.StateMachine(pio1, self.counter, freq=_PIO_FREQ, in_base=machine.Pin(pin1))
+
+        # Make "status" all ones while the TX FIFO is empty, i.e. when there
+        # is no request.
+        self._pio_base = _PIO0_BASE + (pio1 // 4) * 0x100000
+        self._sm = pio1 % 4
+        execctrl = self._pio_base + _SM0_EXECCTRL + self._sm * 0x18
+        mem32[execctrl] = (mem32[execctrl] & ~0x1f) | 1
+
         self.sm1.active(1)
-        self.buf = array.array('i', [0])
-    
+        self.since_edge_us = 0
+
     def read(self):
-        self.sm1.put(1)
+        # Interrupts are disabled during the exchange so that a timer
+        # callback reading the same counter cannot take the replies.
+        state = machine.disable_irq()
+        count = self._read()
+        machine.enable_irq(state)
+        return count
+
+    @micropython.viper
+    def _read(self) -> int:
+        pio = ptr32(self._pio_base)
+        sm = int(self._sm)
+        pio[_TXF0 + sm] = 1
+        while pio[_FSTAT] & (_RXEMPTY0 << sm): pass
+        count = int(pio[_RXF0 + sm])
 
-        # For efficiency, here we use an undocumented feature of
-        # StateMachine to read a SIGNED integer value without
-        # allocating a new object.
-        self.sm1.get(self.buf)
-        return self.buf[0]
+        # The time since the last edge, counted down from zero.
+        while pio[_FSTAT] & (_RXEMPTY0 << sm): pass
+        self.since_edge_us = 0 - int(pio[_RXF0 + sm])
+        return count
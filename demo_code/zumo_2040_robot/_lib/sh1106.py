@@ -99,6 +99,14 @@ class SH1106(framebuf.FrameBuffer):
         self.bufsize = self.pages * self.width
         self.renderbuf = bytearray(self.bufsize)
         self.pages_to_update = 0
+        # The changed columns of each page, from dirty_x0 up to but not
+        # including dirty_x1.  A page in pages_to_update with no columns
+        # recorded is sent in full.
+        self.dirty_x0 = bytearray(b'\xff' * self.pages)
+        self.dirty_x1 = bytearray(self.pages)
+        # What was last sent, if enabled with enable_shadow().
+        self.shadow = None
+        self._shadow_stale = False
 
         if self.rotate90:
             self.displaybuf = bytearray(self.bufsize)
@@ -154,80 +162,199 @@ class SH1106(framebuf.FrameBuffer):
 
     def show(self, full_update = False):
         # self.* lookups in loops take significant time (~4fps).
-        (w, p, db, rb) = (self.width, self.pages,
-                          self.displaybuf, self.renderbuf)
-        if self.rotate90:
-            for i in range(self.bufsize):
-                db[w * (i % p) + (i // p)] = rb[i]
-        if full_update:
-            pages_to_update = (1 << self.pages) - 1
-        else:
-            pages_to_update = self.pages_to_update
+        (w, db) = (self.width, self.displaybuf)
+        pages_to_update = self.prepare_updates(full_update)
         #print("Updating pages: {:08b}".format(pages_to_update))
         for page in range(self.pages):
             if (pages_to_update & (1 << page)):
+                (x0, x1) = self.dirty_columns(page)
                 self.write_cmd(_SET_PAGE_ADDRESS | page)
-                self.write_cmd(_LOW_COLUMN_ADDRESS | 2)
-                self.write_cmd(_HIGH_COLUMN_ADDRESS | 0)
-                self.write_data(db[(w*page):(w*page+w)])
+                self.write_cmd(_LOW_COLUMN_ADDRESS | ((x0 + 2) & 0x0f))
+                self.write_cmd(_HIGH_COLUMN_ADDRESS | ((x0 + 2) >> 4))
+                self.write_data(db[(w*page+x0):(w*page+x1)])
+        self.clear_updates()
+
+    def enable_shadow(self, enable=True):
+        # Keeps a copy of what was last sent, so that show() only sends the
+        # bytes that changed since then.  This helps code that redraws the
+        # whole screen each time.  The next show() sends everything without
+        # comparing, since the shadow buffer does not match the screen yet.
+        self.shadow = bytearray(self.bufsize) if enable else None
+        self._shadow_stale = enable
+
+    def prepare_updates(self, full_update=False):
+        # Returns the pages to send, after copying them to displaybuf on a
+        # rotated display and comparing them with the shadow buffer.
+        if self._shadow_stale:
+            full_update = True
+            self._shadow_stale = False
+        if full_update:
+            self.update_all()
+        if self.rotate90:
+            self._remap(self.pages_to_update)
+        if self.shadow is not None:
+            self.pages_to_update = self._diff(self.pages_to_update, full_update)
+        return self.pages_to_update
+
+    @micropython.viper
+    def _remap(self, pages_to_update: int):
+        # Copies the changed columns of each page from the render buffer,
+        # where each byte is 8 pixels across a row of the rotated screen,
+        # to the display buffer, where the row becomes a column.
+        w = int(self.width)
+        p = int(self.pages)
+        db = ptr8(self.displaybuf)
+        rb = ptr8(self.renderbuf)
+        dirty_x0 = ptr8(self.dirty_x0)
+        dirty_x1 = ptr8(self.dirty_x1)
+        for page in range(p):
+            if not (pages_to_update & (1 << page)):
+                continue
+            x0 = dirty_x0[page]
+            x1 = dirty_x1[page]
+            if x0 >= x1:
+                x0 = 0
+                x1 = w
+            i = x0 * p + page
+            for x in range(page * w + x0, page * w + x1):
+                db[x] = rb[i]
+                i += p
+
+    @micropython.viper
+    def _diff(self, pages_to_update: int, full_update: bool) -> int:
+        # Narrows the changed columns of each page to the first and last
+        # bytes that differ from the shadow buffer, dropping pages with no
+        # differences, and copies those columns into the shadow buffer.
+        w = int(self.width)
+        db = ptr8(self.displaybuf)
+        shadow = ptr8(self.shadow)
+        dirty_x0 = ptr8(self.dirty_x0)
+        dirty_x1 = ptr8(self.dirty_x1)
+        for page in range(int(self.pages)):
+            if not (pages_to_update & (1 << page)):
+                continue
+            x0 = dirty_x0[page]
+            x1 = dirty_x1[page]
+            if x0 >= x1:
+                x0 = 0
+                x1 = w
+            base = page * w
+            if not full_update:
+                while x0 < x1 and db[base + x0] == shadow[base + x0]:
+                    x0 += 1
+                while x1 > x0 and db[base + x1 - 1] == shadow[base + x1 - 1]:
+                    x1 -= 1
+                if x0 == x1:
+                    pages_to_update ^= 1 << page
+                    dirty_x0[page] = 0xff
+                    dirty_x1[page] = 0
+                    continue
+            for i in range(base + x0, base + x1):
+                shadow[i] = db[i]
+            dirty_x0[page] = x0
+            dirty_x1[page] = x1
+        return pages_to_update
+
+    def dirty_columns(self, page):
+        # The range of columns of the page to send.
+        x0 = self.dirty_x0[page]
+        x1 = self.dirty_x1[page]
+        if x0 >= x1:
+            return 0, self.width
+        return x0, x1
+
+    def clear_updates(self):
         self.pages_to_update = 0
+        for page in range(self.pages):
+            self.dirty_x0[page] = 0xff
+            self.dirty_x1[page] = 0
+
+    def update_all(self):
+        self.pages_to_update = (1 << self.pages) - 1
+        for page in range(self.pages):
+            self.dirty_x0[page] = 0
+            self.dirty_x1[page] = self.width
 
     def pixel(self, x, y, color=None):
         if color is None:
             return super().pixel(x, y)
         else:
             super().pixel(x, y , color)
-            page = y // 8
-            self.pages_to_update |= 1 << page
+            self.register_updates(y, None, x)
 
     def text(self, text, x, y, color=1):
         super().text(text, x, y, color)
-        self.register_updates(y, y+7)
+        self.register_updates(y, y+7, x, x+8*len(text)-1)
 
     def line(self, x0, y0, x1, y1, color):
         super().line(x0, y0, x1, y1, color)
-        self.register_updates(y0, y1)
+        self.register_updates(y0, y1, x0, x1)
 
     def hline(self, x, y, w, color):
         super().hline(x, y, w, color)
-        self.register_updates(y)
+        self.register_updates(y, None, x, x+w-1)
 
     def vline(self, x, y, h, color):
         super().vline(x, y, h, color)
-        self.register_updates(y, y+h-1)
+        self.register_updates(y, y+h-1, x)
 
     def fill(self, color):
         super().fill(color)
-        self.pages_to_update = (1 << self.pages) - 1
+        self.update_all()
 
     def blit(self, fbuf, x, y, key=-1, palette=None):
         super().blit(fbuf, x, y, key, palette)
-        self.register_updates(y, y+self.height)
+        # A plain FrameBuffer does not know its size, so assume it reaches
+        # the edge of the screen.
+        if isinstance(fbuf, tuple):
+            (w, h) = (fbuf[1], fbuf[2])
+        else:
+            (w, h) = (getattr(fbuf, 'width', 0xff), getattr(fbuf, 'height', 0xff))
+        self.register_updates(y, y+h-1, x, x+w-1)
 
     def scroll(self, x, y):
         # my understanding is that scroll() does a full screen change
         super().scroll(x, y)
-        self.pages_to_update =  (1 << self.pages) - 1
+        self.update_all()
 
     def fill_rect(self, x, y, w, h, color):
         super().fill_rect(x, y, w, h, color)
-        self.register_updates(y, y+h-1)
+        self.register_updates(y, y+h-1, x, x+w-1)
 
     def rect(self, x, y, w, h, color):
         super().rect(x, y, w, h, color)
-        self.register_updates(y, y+h-1)
-
-    def register_updates(self, y0, y1=None):
-        # this function takes the top and optional bottom address of the changes made
-        # and updates the pages_to_change list with any changed pages
-        # that are not yet on the list
+        self.register_updates(y, y+h-1, x, x+w-1)
+
+    def register_updates(self, y0, y1=None, x0=None, x1=None):
+        # this function takes the top and optional bottom address of the changes made,
+        # and optionally the left and right, and adds the columns they cover
+        # to the changed range of each page
+        if y1 is None:
+            y1 = y0
+        if x0 is None:
+            (x0, x1) = (0, 0xff)
+        elif x1 is None:
+            x1 = x0
+        # rearrange the coordinates if they were given from bottom to top
+        if y0 > y1:
+            y0, y1 = y1, y0
+        if x0 > x1:
+            x0, x1 = x1, x0
+        # the columns of a rotated display run down the screen
+        if self.rotate90:
+            (x0, y0, x1, y1) = (y0, x0, y1, x1)
+        x0 = max(0, x0)
+        x1 = min(self.width - 1, x1)
         start_page = max(0, y0 // 8)
-        end_page = max(0, y1 // 8) if y1 is not None else start_page
-        # rearrange start_page and end_page if coordinates were given from bottom to top
-        if start_page > end_page:
-            start_page, end_page = end_page, start_page
+        end_page = min(self.pages - 1, y1 // 8)
+        if x0 > x1:
+            return
         for page in range(start_page, end_page+1):
             self.pages_to_update |= 1 << page
+            if self.dirty_x0[page] > x0:
+                self.dirty_x0[page] = x0
+            if self.dirty_x1[page] <= x1:
+                self.dirty_x1[page] = x1 + 1
 
     def reset(self, res):
         if res is not None:
@@ -1,6 +1,9 @@
 from . import sh1106
-from machine import Pin
+from array import array
+from machine import Pin, mem32
 from micropython import const
+from rp2 import DMA
+from uctypes import addressof
 
 # Wrapper for SH1106 that is safe to use with multiple SPI buses
 # sharing all pins except SCK.
@@ -9,7 +12,8 @@ from micropython import const
 # pin from the bus, and at the beginning of each call it associates
 # it again.
 #
-# Also includes an optimized version of the show() method.
+# Also includes an optimized version of the show() method, and
+# show_async(), which sends the frame over DMA in the background.
 
 # a few register definitions
 _SET_DISP            = const(0xae)
@@ -17,13 +21,38 @@ _LOW_COLUMN_ADDRESS  = const(0x00)
 _HIGH_COLUMN_ADDRESS = const(0x10)
 _SET_PAGE_ADDRESS    = const(0xB0)
 
+# registers used by show_async()
+_DMA_BASE                = const(0x50000000)
+_DMA_MULTI_CHAN_TRIGGER  = const(0x50000430)
+_SPI0_BASE               = const(0x4003c000)
+_SSPDR                   = const(0x08)
+_SSPSR                   = const(0x0c)
+_SSPSR_RNE               = const(1 << 2)
+_SSPDMACR                = const(0x24)
+_DREQ_SPI0_TX            = const(16)
+_IO_BANK0_BASE           = const(0x40014000)
+_OUTOVER_MASK            = const(3 << 8)
+_OUTOVER_LOW             = const(2 << 8)
+_OUTOVER_HIGH            = const(3 << 8)
+
+# Each page is sent by 8 DMA control blocks of 4 words.
+_PAGE_BLOCK_WORDS        = const(32)
+_TRAILER_WORDS           = const(8)
+
 
 class SH1106SharedSpi(sh1106.SH1106_SPI):
     
     def __init__(self, width, height, spi, dc, sck, res=None, cs=None,
-                 rotate=0, external_vcc=False):
+                 rotate=0, external_vcc=False, dc_gpio=None, spi_id=0):
     
         self.sck = sck
+
+        # show_async() needs the GPIO number of dc and the SPI bus number,
+        # since it drives them from DMA.
+        self.dc_gpio = dc_gpio
+        self.spi_id = spi_id
+        self._dma = None
+        self._sending = False
         
         # This first switch can cause a glitch, so do it before resetting.
         # See https://github.com/micropython/micropython/issues/10226
@@ -34,49 +63,199 @@ class SH1106SharedSpi(sh1106.SH1106_SPI):
                          rotate=rotate, external_vcc=external_vcc)
 
     def show(self, full_update = False):
+        self.wait()
+
         # self.* lookups in loops take significant time (~4fps).
-        (w, p, db, rb) = (self.width, self.pages,
-                          self.displaybuf, self.renderbuf)
+        (w, db) = (self.width, self.displaybuf)
         s = self.spi
         dc = self.dc
 
-        if self.rotate90:
-            for i in range(self.bufsize):
-                db[w * (i % p) + (i // p)] = rb[i]
-        if full_update:
-            pages_to_update = (1 << self.pages) - 1
-        else:
-            pages_to_update = self.pages_to_update
+        pages_to_update = self.prepare_updates(full_update)
         
         self.sck.init(mode=Pin.ALT, alt=1)
         
-        # set column low bits once
-        self.dc(0)
         cmd = bytearray(3)
-        cmd[0] = _LOW_COLUMN_ADDRESS | 2
-        cmd[1] = _HIGH_COLUMN_ADDRESS
         
         for page in range(self.pages):
             if (pages_to_update & (1 << page)):
                 # set the start position, inline
+                (x0, x1) = self.dirty_columns(page)
                 dc(0)
+                cmd[0] = _LOW_COLUMN_ADDRESS | ((x0 + 2) & 0x0f)
+                cmd[1] = _HIGH_COLUMN_ADDRESS | ((x0 + 2) >> 4)
                 cmd[2] = _SET_PAGE_ADDRESS | page
                 s.write(cmd)
                 
                 # write the data, inline
                 dc(1)
-                s.write(db[page*w:page*w+w])
+                s.write(db[page*w+x0:page*w+x1])
         
         self.sck.init(mode=Pin.OUT, value=0)
         
-        self.pages_to_update = 0
+        self.clear_updates()
         
     # override unnecessarily slow poweron command in the SH1106 library
     def poweron(self):
         self.write_cmd(_SET_DISP | 0x01)
 
     def write_cmd(self, cmd):
+        self.wait()
         self.sck.init(mode=Pin.ALT, alt=1)
         self.dc(0)
         self.spi.write(bytearray([cmd]))
-        self.sck.init(mode=Pin.OUT, value=0)
\ No newline at end of file
+        self.sck.init(mode=Pin.OUT, value=0)
+
+    def _init_dma(self):
+        # show_async() runs a chain of DMA control blocks: a control channel
+        # copies each block into the registers of a work channel, which
+        # performs it and chains back to the control channel.  Most blocks
+        # just write a register.  dc is switched through the override in
+        # its pad control register, since DMA cannot reach the SIO.  The
+        # bytes are sent by a tx channel while an rx channel counts the
+        # bytes received back; only the rx channel chains back to the
+        # control channel, so dc never changes until the SPI has finished
+        # shifting out the previous bytes.
+        (w, p) = (self.width, self.pages)
+        dr = _SPI0_BASE + self.spi_id * 0x4000 + _SSPDR
+        gpio_ctrl = _IO_BANK0_BASE + 8 * self.dc_gpio + 4
+        normal = mem32[gpio_ctrl] & ~_OUTOVER_MASK
+
+        ctrl, work, tx, rx = DMA(), DMA(), DMA(), DMA()
+        # Keep all four, since a DMA object frees its channel when collected.
+        self._dma = (ctrl, work, tx, rx)
+        work_regs = _DMA_BASE + work.channel * 0x40
+        tx_regs = _DMA_BASE + tx.channel * 0x40
+        rx_regs = _DMA_BASE + rx.channel * 0x40
+        start_mask = (1 << tx.channel) | (1 << rx.channel)
+
+        tx.config(write=dr, ctrl=tx.pack_ctrl(
+            size=0, inc_write=False, treq_sel=_DREQ_SPI0_TX + 2 * self.spi_id))
+        rx.config(read=dr, ctrl=rx.pack_ctrl(
+            size=0, inc_read=False, inc_write=False,
+            treq_sel=_DREQ_SPI0_TX + 2 * self.spi_id + 1, chain_to=ctrl.channel))
+        self._dma_ctrl = ctrl.pack_ctrl(inc_write=True, ring_sel=True, ring_size=4)
+        self._dma_work_regs = work_regs
+        chain = work.pack_ctrl(chain_to=ctrl.channel)
+        no_chain = work.pack_ctrl()
+
+        self._dma_buf = bytearray(self.bufsize)
+        self._dma_cmds = bytearray(3 * p)
+        self._dma_sink = bytearray(4)
+        buf = addressof(self._dma_buf)
+        cmds = addressof(self._dma_cmds)
+        sink = addressof(self._dma_sink)
+
+        # The blocks for every page, which show_async() copies for the
+        # dirty ones, and the values they write.
+        values = self._dma_values = array('I', [0] * (16 * p + 1))
+        blocks = self._dma_page_blocks = array('I', [0] * (_PAGE_BLOCK_WORDS * p))
+        v = addressof(values)
+        targets = (gpio_ctrl, tx_regs, rx_regs, _DMA_MULTI_CHAN_TRIGGER)
+        for page in range(p):
+            # _queue() fills in the columns
+            self._dma_cmds[3 * page + 2] = _SET_PAGE_ADDRESS | page
+            i = 16 * page
+            b = _PAGE_BLOCK_WORDS * page
+            for (value, data, length) in ((normal | _OUTOVER_LOW, cmds + 3 * page, 3),
+                                          (normal | _OUTOVER_HIGH, buf + w * page, w)):
+                for (j, x) in enumerate((value, data, dr, length, dr, sink, length, start_mask)):
+                    values[i + j] = x
+                for j in range(4):
+                    blocks[b + 4 * j] = v + 4 * (i + (0, 1, 4, 7)[j])
+                    blocks[b + 4 * j + 1] = targets[j]
+                    blocks[b + 4 * j + 2] = (1, 3, 3, 1)[j]
+                    blocks[b + 4 * j + 3] = no_chain if j == 3 else chain
+                i += 8
+                b += 16
+
+        # Hand dc back to the SIO, then stop with a null block.
+        values[16 * p] = normal
+        self._dma_trailer = array('I', [v + 4 * 16 * p, gpio_ctrl, 1, chain, 0, 0, 0, 0])
+        self._dma_blocks = array('I', [0] * (_PAGE_BLOCK_WORDS * p + _TRAILER_WORDS))
+        self._dma_end = 0
+
+    @micropython.viper
+    def _queue(self, pages_to_update: int) -> int:
+        # Copies the dirty pages and their blocks, and sets the columns to
+        # send, returning the number of block words.
+        w = int(self.width)
+        words = w >> 2
+        src = ptr32(self.displaybuf)
+        dst = ptr32(self._dma_buf)
+        buf = int(dst)
+        dirty_x0 = ptr8(self.dirty_x0)
+        dirty_x1 = ptr8(self.dirty_x1)
+        cmds = ptr8(self._dma_cmds)
+        values = ptr32(self._dma_values)
+        page_blocks = ptr32(self._dma_page_blocks)
+        blocks = ptr32(self._dma_blocks)
+        trailer = ptr32(self._dma_trailer)
+        n = 0
+        for page in range(int(self.pages)):
+            if pages_to_update & (1 << page):
+                for i in range(page * words, page * words + words):
+                    dst[i] = src[i]
+                x0 = dirty_x0[page]
+                x1 = dirty_x1[page]
+                if x0 >= x1:
+                    x0 = 0
+                    x1 = w
+                cmds[3 * page] = _LOW_COLUMN_ADDRESS | ((x0 + 2) & 0x0f)
+                cmds[3 * page + 1] = _HIGH_COLUMN_ADDRESS | ((x0 + 2) >> 4)
+                v = 16 * page + 8
+                values[v + 1] = buf + w * page + x0
+                values[v + 3] = x1 - x0
+                values[v + 6] = x1 - x0
+                for i in range(_PAGE_BLOCK_WORDS):
+                    blocks[n + i] = page_blocks[page * _PAGE_BLOCK_WORDS + i]
+                n += _PAGE_BLOCK_WORDS
+        for i in range(_TRAILER_WORDS):
+            blocks[n + i] = trailer[i]
+        return n + _TRAILER_WORDS
+
+    def show_async(self, full_update = False):
+        # Like show(), but returns as soon as the transfer has started.  The
+        # frame is copied first, so you can draw the next one right away,
+        # but call wait() before anything else uses the SPI bus.
+        if self.dc_gpio is None:
+            return self.show(full_update)
+        self.wait()
+        if self._dma is None:
+            self._init_dma()
+
+        pages_to_update = self.prepare_updates(full_update)
+        if not pages_to_update:
+            return
+
+        n = self._queue(pages_to_update)
+        self.clear_updates()
+        self._dma_end = addressof(self._dma_blocks) + 4 * n
+
+        # The rx channel counts received bytes, so nothing stale may be
+        # left in the FIFO.
+        spi = _SPI0_BASE + self.spi_id * 0x4000
+        while mem32[spi + _SSPSR] & _SSPSR_RNE:
+            mem32[spi + _SSPDR]
+        mem32[spi + _SSPDMACR] = 3
+
+        self.sck.init(mode=Pin.ALT, alt=1)
+        self._sending = True
+        (ctrl, work, tx, rx) = self._dma
+        ctrl.config(read=self._dma_blocks, write=self._dma_work_regs,
+                    count=4, ctrl=self._dma_ctrl, trigger=True)
+
+    def busy(self):
+        # True while show_async() is still sending.
+        if not self._sending:
+            return False
+        (ctrl, work, tx, rx) = self._dma
+        if (ctrl.active() or work.active() or tx.active() or rx.active()
+                or ctrl.read != self._dma_end):
+            return True
+        self.sck.init(mode=Pin.OUT, value=0)
+        self._sending = False
+        return False
+
+    def wait(self):
+        while self.busy():
+            pass
@@ -0,0 +1,54 @@
+# Run this test with the motors stopped.  It overrides the inputs from
+# the left encoder's pins to step its counter back and forth through zero.
+
+from zumo_2040_robot import robot
+from machine import mem32
+import time
+
+_IO_BANK0_BASE = 0x40014000
+_INOVER_MASK = 3 << 16
+_INOVER_LOW = 2 << 16
+_INOVER_HIGH = 3 << 16
+
+# The left encoder is on GPIO 12 and 13.
+def set_pins(a, b):
+    for (gpio, value) in ((12, a), (13, b)):
+        ctrl = _IO_BANK0_BASE + 8 * gpio + 4
+        mem32[ctrl] = (mem32[ctrl] & ~_INOVER_MASK) | (_INOVER_HIGH if value else _INOVER_LOW)
+    time.sleep_ms(1)
+
+def release_pins():
+    for gpio in (12, 13):
+        ctrl = _IO_BANK0_BASE + 8 * gpio + 4
+        mem32[ctrl] &= ~_INOVER_MASK
+
+# pin 12, pin 13 for each step that decrements the PIO counter
+backward = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
+encoders = robot.Encoders()
+counter = encoders.left
+
+try:
+    set_pins(0, 0)
+    start = counter.read()
+    print("Encoders: start at {}".format(start))
+
+    for i in range(1, 13):
+        set_pins(*backward[i % 4])
+        count = counter.read()
+        assert count == start - i, "backward step {}: got {}".format(i, count)
+    assert count < 0, "count should go below zero"
+
+    for i in range(11, -1, -1):
+        set_pins(*backward[i % 4])
+        count = counter.read()
+        assert count == start - i, "forward step {}: got {}".format(i, count)
+
+    # The time since the last edge keeps counting while nothing changes.
+    time.sleep_ms(20)
+    counter.read()
+    assert counter.since_edge_us >= 20000
+finally:
+    release_pins()
+
+print("Encoders test passed")
@@ -0,0 +1,79 @@
+# Run this test to check Font lookups and Display.font_text().  It writes a
+# small font file in the layout made by generate_font.py, so it does not
+# need the generated fonts.
+
+from zumo_2040_robot import robot
+from zumo_2040_robot.font import Font
+import os
+
+FILENAME = "font_test.bin"
+
+question = bytes([0x02, 0x01, 0x51, 0x09, 0x06, 0x00, 0x00, 0x00])
+letter_a = bytes([0x7e, 0x11, 0x11, 0x11, 0x7e, 0x00, 0x80, 0x01])
+e_acute = bytes([0x38, 0x54, 0x56, 0x55, 0x18, 0x00, 0x00, 0x00])
+codepoints = [0x3f, 0x41, 0xe9]
+glyphs = [question, letter_a, e_acute]
+
+def u32(value):
+    return bytes([value & 0xff, value >> 8 & 0xff, value >> 16 & 0xff, value >> 24])
+
+size = 16 + len(codepoints) * (4 + 8)
+data = u32(size) + u32(len(codepoints)) + u32(4) + bytes([8, 8, 8, 0])
+for codepoint in codepoints:
+    data += u32(codepoint)
+for glyph in glyphs:
+    data += glyph
+with open(FILENAME, "wb") as f:
+    f.write(data)
+
+try:
+    font = Font(FILENAME)
+finally:
+    os.remove(FILENAME)
+
+assert (font.width, font.height, font.count) == (8, 8, 3)
+for i in range(3):
+    assert font._find(codepoints[i]) == i
+assert font._find(0x40) == -1
+assert font._find(0x20) == -1
+assert bytes(font.glyph(ord("A"))) == letter_a, "present glyph"
+assert bytes(font.glyph(ord("é"))) == e_acute, "present glyph"
+assert bytes(font.glyph(ord("B"))) == question, "fallback glyph"
+
+try:
+    Font("no_such_font.bin")
+    assert False, "missing file should raise"
+except OSError as e:
+    assert "generate_font.py" in str(e)
+
+display = robot.Display()
+db = display.displaybuf
+w = display.width
+
+# clipped at the left edge
+display.fill(0)
+display.clear_updates()
+assert display.font_text(font, "A", -3, 8) == 5
+assert bytes(db[w:w + 5]) == letter_a[3:], "clipped on the left"
+assert display.dirty_x0[1] == 0 and display.dirty_x1[1] == 5
+
+# clipped at the right edge, with nothing wrapping onto the next page
+assert display.font_text(font, "AA", w - 4, 16) == w + 12
+assert bytes(db[2 * w + w - 4:3 * w]) == letter_a[:4], "clipped on the right"
+assert max(db[3 * w:4 * w]) == 0, "nothing wrapped"
+assert display.dirty_x0[2] == w - 4 and display.dirty_x1[2] == w
+
+# inverted
+display.font_text(font, "A", 0, 40, 0)
+assert bytes(db[5 * w:5 * w + 8]) == bytes(b ^ 0xff for b in letter_a), "inverted"
+
+# not page-aligned, drawn with blit()
+display.fill(0)
+display.font_text(font, "A", 10, 4)
+for x in range(8):
+    for y in range(8):
+        assert display.pixel(10 + x, 4 + y) == letter_a[x] >> y & 1, "unaligned"
+
+display.fill(0)
+display.show()
+print("Font test passed")
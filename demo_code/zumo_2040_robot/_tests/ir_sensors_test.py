@@ -21,6 +21,8 @@ assert stop - start > 1000, "should take time to measure"
 assert min(data) > 100
 assert max(data) < 900
 assert line_sensors._state() == 0
+assert line_sensors.frame_info[2] == 0, "status OK"
+seq = line_sensors.frame_info[0]
 
 # test the effect of a long delay
 time.sleep_ms(10)
@@ -34,6 +36,8 @@ stop = time.ticks_us()
 
 print("Line: Non-blocking read: {}us {}".format(stop - start, data2))
 assert stop - start < 500, "fast non-blocking read"
+assert line_sensors.frame_info[0] == seq + 1, "sequence number"
+assert line_sensors.frame_info[1] > 500, "age of a reading started 2ms ago"
 assert min(data2) > 100
 assert max(data2) < 900
 assert line_sensors._state() == 0
@@ -60,6 +64,78 @@ assert data[2] == 1000, "out of range high"
 assert data[3] == 0, "division by zero"
 assert abs(data[4] - data2[4]) < 20, "uncalibrated"
 
+# saving and loading calibration
+line_sensors.save_calibration("test.cal")
+cal_min = line_sensors.cal_min[:]
+cal_max = line_sensors.cal_max[:]
+line_sensors.reset_calibration()
+assert line_sensors.load_calibration("test.cal")
+assert line_sensors.cal_min == cal_min and line_sensors.cal_max == cal_max
+assert not line_sensors.load_calibration("missing.cal")
+import os
+os.remove("test.cal")
+
+# line position, interpolated between sensors
+position = line_sensors.read_line_position()
+print("Line position: {}".format(position))
+assert position > 0 and position < 4000, "weighted average"
+assert line_sensors.last_position == position
+line_sensors.cal_min = array.array('H', [1025] * 5)
+line_sensors.cal_max = array.array('H', [1024] * 5)
+line_sensors.last_position = 3000
+assert line_sensors.read_line_position() == 4000, "last seen on the right"
+line_sensors.last_position = 0
+assert line_sensors.read_line_position() == 0, "last seen on the left"
+line_sensors.reset_calibration()
+
+# streaming calibration ignores a single outlier
+for i in range(100):
+    line_sensors._add_calibration_sample(array.array('H', [500] * 5))
+line_sensors._add_calibration_sample(array.array('H', [1000] * 5))
+line_sensors._update_calibration()
+assert line_sensors.cal_min[0] == 496 and line_sensors.cal_max[0] == 503
+line_sensors.reset_calibration()
+
+# test continuous mode
+line_sensors.start_continuous()
+time.sleep_ms(5)
+start = time.ticks_us()
+data3 = line_sensors.read()[:]
+stop = time.ticks_us()
+
+print("Line: Continuous read: {}us {}".format(stop - start, data3))
+assert stop - start < 500, "fast non-blocking read"
+for i in range(5):
+    assert abs(data2[i] - data3[i]) < 20
+line_sensors.read()
+assert line_sensors.frame_info[2] == 1, "stale: no new reading yet"
+time.sleep_ms(2)
+line_sensors.read()
+assert line_sensors.frame_info[2] == 0, "new reading"
+line_sensors.start_read() # should not disturb continuous mode
+assert line_sensors._state() == 2
+line_sensors.stop_continuous()
+assert line_sensors._state() == 0
+
+# test ambient cancelling; indoors there is little ambient IR, so the result
+# should be close to a normal reading
+line_sensors.read_ambient_cancelled()
+start = time.ticks_us()
+for i in range(10):
+    data3 = line_sensors.read_ambient_cancelled()
+stop = time.ticks_us()
+
+print("Line: Ambient cancelled: {}us per read {}".format((stop - start) // 10, data3))
+assert (stop - start) // 10 < 1250, "faster than 800 Hz"
+for i in range(5):
+    assert abs(data2[i] - data3[i]) < 50
+
+# the reading left running has the emitters off, so read() should replace it
+assert not line_sensors._emitters_on
+data3 = line_sensors.read()[:]
+for i in range(5):
+    assert abs(data2[i] - data3[i]) < 20, "read() with the emitters on"
+
 #### BUMP SENSORS
 
 # test without starting the read ahead of time
@@ -2,13 +2,18 @@ from ._lib import sh1106_shared_spi
 from machine import Pin, SPI
 import framebuf
 
+@micropython.viper
+def _copy_inverted(dst: ptr8, offset: int, src: ptr8, n: int):
+    for i in range(n):
+        dst[offset + i] = src[i] ^ 0xff
+
 class Display(sh1106_shared_spi.SH1106SharedSpi):
     def __init__(self):
         sck_pin = Pin(2)
         spi = SPI(id=0, baudrate=4000000, polarity=0, phase=0, sck=sck_pin, mosi=Pin(3), miso=None)
         dc = Pin(0)   # data/command
         res = Pin(1)  # reset
-        super().__init__(128, 64, spi, dc, sck_pin, res=res, rotate=180)
+        super().__init__(128, 64, spi, dc, sck_pin, res=res, rotate=180, dc_gpio=0)
 
     def load_pbm(self, filename):
         with open(filename, 'rb') as f:
@@ -26,6 +31,44 @@ class Display(sh1106_shared_spi.SH1106SharedSpi):
             f.write("P4\n128 64\n")
             f.write(data)
 
+    def font_text(self, font, text, x, y, color=1):
+        # Draws text in a Font from zumo_2040_robot.font and returns the x
+        # coordinate just after it.  Unlike text(), each character's
+        # background is filled with the opposite color.  When y is a
+        # multiple of 8, the glyphs are copied straight into the display
+        # buffer, which is faster than text().
+        (w, h) = (font.width, font.height)
+        start = x
+        if y & 7 or y < 0 or self.rotate90:
+            palette = None
+            if not color:
+                palette = framebuf.FrameBuffer(bytearray(1), 2, 1, framebuf.MONO_HLSB)
+                palette.pixel(0, 0, 1)
+            for char in text:
+                g = font.glyph(ord(char))
+                if g is not None:
+                    fb = framebuf.FrameBuffer(g, w, h, framebuf.MONO_VLSB)
+                    framebuf.FrameBuffer.blit(self, fb, x, y, -1, palette)
+                x += w
+        else:
+            (db, width) = (self.displaybuf, self.width)
+            pages = min(h // 8, self.pages - y // 8)
+            for char in text:
+                g = font.glyph(ord(char)) if -w < x < width else None
+                if g is not None:
+                    c0 = max(0, -x)
+                    c1 = min(w, width - x)
+                    for p in range(pages):
+                        d = (y // 8 + p) * width + x
+                        if color:
+                            db[d + c0:d + c1] = g[p * w + c0:p * w + c1]
+                        else:
+                            _copy_inverted(db, d + c0, g[p * w + c0:], c1 - c0)
+                x += w
+        if x > start:
+            self.register_updates(y, y + h - 1, start, x - 1)
+        return x
+
     def exception(self, e):
         self.text(type(e).__name__ + ":", 0, 0, 1)
         try:
@@ -1,3 +1,15 @@
+from array import array
+from machine import disable_irq, enable_irq
+from time import ticks_us, ticks_add, ticks_diff
+
+# FIFO registers of PIO0, where the left and right counters run on state
+# machines 0 and 1.
+_PIO0_BASE = const(0x50200000)
+_FSTAT = const(0x004 >> 2)
+_TXF0 = const(0x010 >> 2)
+_RXF0 = const(0x020 >> 2)
+_RXEMPTY0 = const(1 << 8)
+
 class Encoders:
     def __init__(self):
         from ._lib.pio_quadrature_counter import PIOQuadratureCounter
@@ -8,19 +20,100 @@ class Encoders:
         # Zero counts
         self.left_offset = 0
         self.right_offset = 0
+        self._counts = array('i', [0, 0])
+        self._speeds = array('i', [0, 0])
+        # the counters' own counts from the last read_counts()
+        self._raw = array('i', [0, 0])
         self.get_counts(reset = True)
 
+        # For measuring speed: the count and time at the most recent edge
+        # seen by each encoder, and the last speed measured.
+        now = ticks_us()
+        self._left_edge = [self._raw[0], now, 0]
+        self._right_edge = [self._raw[1], now, 0]
+
     def flip(self, flip):
         self._flip_sign = -1 if flip else 1
 
     def get_counts(self, reset = False):
+        counts = self._counts
+        self.read_counts(counts)
+
+        if reset:
+            self.left_offset += counts[0] * self._flip_sign
+            self.right_offset += counts[1] * self._flip_sign
+
+        return counts[0], counts[1]
+
+    def read_counts(self, buf):
+        # Reads both counts into buf, an array('i', 2), without allocating.
+        # Both counters get their requests together so the counts are taken
+        # at the same moment.  Interrupts are disabled during the exchange,
+        # so a timer callback (such as Odometry or SpeedController) reading
+        # the encoders cannot take the main program's replies.  Do not read
+        # the encoders from both cores.
+        state = disable_irq()
+        self._read_counts(buf)
+        enable_irq(state)
+
+    @micropython.viper
+    def _read_counts(self, buf):
+        pio = ptr32(_PIO0_BASE)
+        pio[_TXF0] = 1
+        pio[_TXF0 + 1] = 1
+
+        # Each counter replies with its count and the time since its last
+        # edge.
+        while pio[_FSTAT] & _RXEMPTY0: pass
+        left = int(pio[_RXF0])
+        while pio[_FSTAT] & _RXEMPTY0: pass
+        self.left.since_edge_us = -int(pio[_RXF0])
+        while pio[_FSTAT] & (_RXEMPTY0 << 1): pass
+        right = int(pio[_RXF0 + 1])
+        while pio[_FSTAT] & (_RXEMPTY0 << 1): pass
+        self.right.since_edge_us = -int(pio[_RXF0 + 1])
+        raw = ptr32(self._raw)
+        raw[0] = left
+        raw[1] = right
+
         # Sign on the Zumo encoders is reversed from what
         # the PIO counter gives us.
-        left = - self.left.read() - self.left_offset
-        right = - self.right.read() - self.right_offset
+        flip = int(self._flip_sign)
+        counts = ptr32(buf)
+        counts[0] = (0 - left - int(self.left_offset)) * flip
+        counts[1] = (0 - right - int(self.right_offset)) * flip
 
-        if reset:
-            self.left_offset += left
-            self.right_offset += right
+    def _speed(self, count, since, now, edge):
+        if count != edge[0]:
+            # Counts per second between the edge before the last reading and
+            # the newest edge.  This is accurate at any speed, since it does
+            # not depend on when the readings are taken.
+            edge_time = ticks_add(now, -since)
+            dt = ticks_diff(edge_time, edge[1])
+            if dt > 0:
+                edge[2] = (count - edge[0]) * 1000000 // dt
+            edge[0] = count
+            edge[1] = edge_time
+        elif since > 0:
+            # No new edges, so the wheel is turning no faster than one count
+            # in the time since the last one.
+            limit = 1000000 // since
+            if edge[2] > limit: edge[2] = limit
+            elif edge[2] < -limit: edge[2] = -limit
+        return -edge[2] * self._flip_sign
+
+    def get_speeds(self):
+        # Returns the speed of each wheel in counts per second, measured by
+        # the PIO counters from the time between encoder edges.
+        speeds = self.read_speeds(self._speeds)
+        return speeds[0], speeds[1]
 
-        return left * self._flip_sign, right * self._flip_sign
+    def read_speeds(self, buf):
+        # Like get_speeds(), but reads into buf, an array('i', 2), without
+        # allocating.  Both wheels are measured at the same moment, from one
+        # read_counts().
+        self.read_counts(buf)
+        now = ticks_us()
+        buf[0] = self._speed(self._raw[0], self.left.since_edge_us, now, self._left_edge)
+        buf[1] = self._speed(self._raw[1], self.right.since_edge_us, now, self._right_edge)
+        return buf
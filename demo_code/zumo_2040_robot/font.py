@@ -0,0 +1,56 @@
+from micropython import const
+
+_HEADER_SIZE = const(16)
+_FALLBACK = const(0x3f)  # "?"
+
+class Font:
+    """A font made by generate_font.py.  Each glyph is stored as columns of
+    8-pixel high pages, the same layout as the display, for drawing with
+    Display.font_text()."""
+    def __init__(self, filename):
+        # The file is small enough to keep in RAM; glyphs are memoryviews
+        # into it, so looking them up does not copy anything.
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            raise OSError(f"Font file {filename} not found; generate it with generate_font.py") from None
+        with f:
+            size = int.from_bytes(f.read(4), 'little')
+            f.seek(0)
+            self.data = bytearray(size)
+            f.readinto(self.data)
+        data = self.data
+        self.count = int.from_bytes(data[4:8], 'little')
+        self.search_mask = int.from_bytes(data[8:12], 'little')
+        self.glyph_size = data[12]
+        self.width = data[13]
+        self.height = data[14]
+        self._glyphs_start = _HEADER_SIZE + 4 * self.count
+        self._mv = memoryview(data)
+
+    @micropython.viper
+    def _find(self, codepoint: int) -> int:
+        # Binary search of the sorted codepoints after the header.
+        codes = ptr32(self.data)
+        count = int(self.count)
+        i = 0
+        bit = int(self.search_mask) >> 1
+        while bit:
+            j = i | bit
+            if j < count and int(codes[4 + j]) <= codepoint:
+                i = j
+            bit >>= 1
+        if count and int(codes[4 + i]) == codepoint:
+            return i
+        return -1
+
+    def glyph(self, codepoint):
+        # Returns the glyph's bytes, page by page, or those of "?" if the
+        # font does not have it.
+        i = self._find(codepoint)
+        if i < 0:
+            i = self._find(_FALLBACK)
+            if i < 0:
+                return None
+        start = self._glyphs_start + i * self.glyph_size
+        return self._mv[start:start + self.glyph_size]
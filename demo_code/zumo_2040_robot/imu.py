@@ -1,8 +1,83 @@
+import math
+from array import array
+from machine import Pin, Timer
+from micropython import const, schedule
+from time import ticks_ms, ticks_us, ticks_diff
+
+SAMPLE_RING_SIZE = const(16)
+
+class SampleTimes:
+    """Reads a sensor in the background as new readings arrive and records
+    when each one arrived."""
+    def __init__(self, sensor, pin=None, read=None):
+        # read, if given, is called for each reading instead of
+        # sensor.read().
+        self.sensor = sensor
+        self.pin = pin
+        self.running = False
+
+        # Arrival times from ticks_us() of the last SAMPLE_RING_SIZE readings;
+        # the newest is at (count - 1) % SAMPLE_RING_SIZE.
+        self.times = array('i', [0] * SAMPLE_RING_SIZE)
+        self.count = 0
+
+        self._pending = False
+        self._irq_time = 0
+        self._timer = None
+        # bind once so the interrupt handlers do not allocate
+        self._irq_cb = self._irq
+        self._read_cb = self._read
+        self._read_sensor = read or sensor.read
+
+    def start(self):
+        # Uses the sensor's data ready pin if it is connected, which gives
+        # each reading the time it arrived.  Otherwise, reads at the output
+        # data rate from a hard timer, without checking the sensor's status
+        # register first.  The sensor's clock is not exactly in step with
+        # the timer, so a reading is occasionally read twice or skipped.
+        if self.pin is not None:
+            Pin(self.pin, Pin.IN).irq(self._irq_cb, trigger=Pin.IRQ_RISING, hard=True)
+        else:
+            self._timer = Timer(freq=self.sensor.output_data_rate,
+                                mode=Timer.PERIODIC, callback=self._irq_cb,
+                                hard=True)
+        self.running = True
+
+    def stop(self):
+        if self.pin is not None:
+            Pin(self.pin, Pin.IN).irq(None)
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+        self.running = False
+
+    def last_time(self):
+        # The arrival time of the newest reading.
+        return self.times[(self.count - 1) % SAMPLE_RING_SIZE]
+
+    def _record(self, time):
+        self.times[self.count % SAMPLE_RING_SIZE] = time
+        self.count += 1
+
+    def _irq(self, _):
+        # Called from the data ready pin or the timer.  Reading over I2C has
+        # to wait until we are out of the interrupt, so the time is recorded
+        # once the reading is done.
+        self._irq_time = ticks_us()
+        if not self._pending:
+            self._pending = True
+            schedule(self._read_cb, None)
+
+    def _read(self, _):
+        self._pending = False
+        self._read_sensor()
+        self._record(self._irq_time)
+
 class IMU:
-    def __init__(self, i2c=None):
+    def __init__(self, i2c=None, gyro_int_pin=None, mag_drdy_pin=None):
         from ._lib import lis3mdl, lsm6dso
         if i2c is None:
-            from machine import I2C, Pin
+            from machine import I2C
             i2c = I2C(id=0, scl=Pin(5), sda=Pin(4), freq=400_000)
             # Send low pulses on SCL to fix devices that are stuck
             # driving SDA low.
@@ -15,6 +90,12 @@ class IMU:
         self.acc = self._lsm6dso.acc
         self.mag = self._lis3mdl
 
+        # The interrupt pins are not connected on the Zumo, but can be passed
+        # in if you have wired them to spare GPIOs.  The accelerometer is
+        # read along with the gyro.
+        self.gyro_times = SampleTimes(self.gyro, gyro_int_pin, self._lsm6dso.read)
+        self.mag_times = SampleTimes(self.mag, mag_drdy_pin)
+
     def detect(self):
         return self._lsm6dso.detect() and self._lis3mdl.detect()
 
@@ -26,7 +107,60 @@ class IMU:
         self._lsm6dso.enable_default()
         self._lis3mdl.enable_default()
 
+    def start_sampling(self):
+        # Keeps gyro.last_reading_dps, acc.last_reading_g and
+        # mag.last_reading_gauss up to date in the background.  Check gyro_times.count and mag_times.count for
+        # new readings instead of calling data_ready(), and use
+        # last_time() for when they arrived.
+        if self.gyro_times.pin is not None:
+            self.gyro.enable_data_ready_int1()
+        self.gyro_times.start()
+        self.mag_times.start()
+
+    def stop_sampling(self):
+        self.gyro_times.stop()
+        self.mag_times.stop()
+
     def read(self):
-        self.gyro.read()
-        self.acc.read()
+        self._lsm6dso.read()
         self.mag.read()
+
+    def read_gyro_acc(self):
+        # Reads the gyro and accelerometer in one I2C transaction, without
+        # the magnetometer.
+        self._lsm6dso.read()
+
+    def calibrate_mag(self, motors, speed=1500, duration_ms=4000):
+        # Spins the robot in place on its motors while recording magnetometer
+        # readings, then fits the hard and soft iron calibration.  Save it
+        # with mag.save_calibration().  Returns False if the fit failed.
+        self.mag.reset_calibration()
+        start = ticks_ms()
+        motors.set_speeds(-speed, speed)
+        try:
+            while ticks_diff(ticks_ms(), start) < duration_ms:
+                if self.mag.data_ready():
+                    self.mag.read()
+                    if not self.mag.add_calibration_sample():
+                        break
+        finally:
+            motors.off()
+        return self.mag.fit_calibration()
+
+    def heading(self):
+        # Returns the compass heading in degrees from 0 to 360 (clockwise
+        # from magnetic north, seen from above) using the last magnetometer
+        # and accelerometer readings, corrected for the robot's tilt.
+        ax, ay, az = self.acc.last_reading_g
+        mx, my, mz = self.mag.last_reading_gauss
+        roll = math.atan2(ay, az)
+        sin_roll = math.sin(roll)
+        cos_roll = math.cos(roll)
+        pitch = math.atan2(-ax, ay * sin_roll + az * cos_roll)
+        sin_pitch = math.sin(pitch)
+        cos_pitch = math.cos(pitch)
+
+        # Rotate the magnetic field back to level.
+        bx = mx * cos_pitch + (my * sin_roll + mz * cos_roll) * sin_pitch
+        by = my * cos_roll - mz * sin_roll
+        return math.degrees(math.atan2(by, bx)) % 360
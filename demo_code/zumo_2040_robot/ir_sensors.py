@@ -1,12 +1,53 @@
 from machine import Pin
 from array import array
+from uctypes import addressof
+from time import ticks_us
 import rp2
-from rp2 import PIO
+from rp2 import PIO, DMA
 
 SENSOR_COUNT = const(5)
 TIMEOUT = const(1024)
 _DONE = const(0)
 _READ_LINE = const(1)
+_CONTINUOUS = const(2)
+
+# Indexes into frame_info, which describes the reading last returned by read().
+FRAME_SEQ = const(0)     # increments with each new reading
+FRAME_AGE_US = const(1)  # microseconds since the reading finished
+FRAME_STATUS = const(2)  # one of the STATUS_* values below
+
+STATUS_OK = const(0)       # a new, complete reading
+STATUS_STALE = const(1)    # no new reading since the last call to read()
+STATUS_PARTIAL = const(2)  # the reading did not finish in time; sensors that
+                           # were not measured are reported as TIMEOUT
+
+# A reading takes ~32us of charging plus 1024 1us loop iterations.
+_READ_US = const(1060)
+_READ_TIMEOUT_US = const(2000)
+_TICKS_MAX = const(0x3fffffff)
+
+# Calibration keeps a histogram of every reading for each sensor, with bins
+# 8 counts wide, and ignores the lowest and highest 2% of readings.
+_BIN_SHIFT = const(3)
+_BIN_COUNT = const((TIMEOUT >> _BIN_SHIFT) + 1)
+_REJECT_PER_MILLE = const(20)
+
+CALIBRATION_FILE = "line_sensors.cal"
+
+# Number of 32-bit words in the DMA ring buffer used for continuous reads.
+# Each reading takes about 6 words, so this holds several readings.  Must be a
+# power of two.
+RING_SIZE = const(64)
+
+# A word that the PIO program can never produce, used to fill the ring buffer
+# before the first reading arrives.
+_EMPTY = const(0xfffffffe)
+
+_PIO0_BASE = const(0x50200000)
+_PIO_RXF0 = const(0x20)
+_DMA_BASE = const(0x50000000)
+_DMA_WRITE_ADDR = const(0x04)
+_DMA_AL2_WRITE_ADDR_TRIG = const(0x2c)
 _state = _DONE
 _qtr = None
 
@@ -19,18 +60,25 @@ class QTRSensors:
         fifo_join=PIO.JOIN_RX
         )
     def counter():
-        # The CPU initializes a few of the registers before this PIO program is restarted.
-        #   OSR = 32 bits of 1s for future shifting out to initialize pindirs and Y.
-        #         This requires SENSOR_COUNT + 10 bits.
-        #   Y = 255 this will result in the loop at 'change' below delaying for ~32usec.
-        #   X = 7 bits of 1s as the last pin state.
+        # The program wraps around after every reading, so it runs readings
+        # back-to-back until the CPU stops it.  For a single reading, the CPU
+        # stops it after receiving the 0xFFFFFFFF marker.
+        wrap_target()
+
+        # Set OSR to 32 bits of 1s for future shifting out to initialize pindirs and Y.
+        # This requires 8 + 7 + SENSOR_COUNT + 10 bits.
+        mov(osr, invert(null))
+
+        # Set Y counter to 255 by pulling 8 high bits from OSR. At 8MHz this results in ~32us of charge time.
+        out(y, 8)
+
+        # Initialize X (last pin state) to 7 bits of 1s.
+        out(x, 7)
 
-        # OSR already contains 32 bits of 1s put there by the CPU before restarting the state machine.
         # Set pindirs to 7 bits of 1s to enable output and start charging the capacitor.
         out(pindirs, SENSOR_COUNT)
 
         # Charge up the capacitors for ~32us.
-        # Y was initialized already by the CPU before restarting the state machine.
         label("charge")
         jmp(y_dec, "charge")
 
@@ -76,9 +124,6 @@ class QTRSensors:
 
         # Send 0xFFFFFFFF to tell the CPU we are done.
         in_(y, 32)
-
-        wrap_target()
-        nop()
         wrap()
 
     def __init__(self, id, pin1):
@@ -92,26 +137,98 @@ class QTRSensors:
         self.sm = rp2.StateMachine(id, self.counter, freq=8000000, in_base=p, out_base=p)
         self.data_line = array('H', [0] * 5)
 
-        # Compile and save away PIO instructions that initialize registers in
-        # the state machine so that we don't need to waste precious PIO code
-        # space.
-        self.pio_instrs = array('H')
-        # Set OSR to 32 bits of 1s for future shifting out to initialize pindirs and y.
-        self.pio_instrs.append(rp2.asm_pio_encode("mov(osr, invert(null))", 0))
-        # Set Y counter to 255 by pulling 8 high bits from OSR. At 8MHz this results in ~32us of charge time.
-        self.pio_instrs.append(rp2.asm_pio_encode("out(y, 8)", 0))
-        # Initialize X (last pin state) to 7 bits of 1s.
-        self.pio_instrs.append(rp2.asm_pio_encode("out(x, 7)", 0))
+        # Continuous mode: DMA copies the words pushed by the PIO program into
+        # a ring buffer, and a second DMA channel rewinds the first one each
+        # time it reaches the end.
+        self.ring = array('I', [_EMPTY] * RING_SIZE)
+        self.ring_start = array('I', [addressof(self.ring)])
+        self.rx_fifo_addr = _PIO0_BASE + (id // 4) * 0x100000 + _PIO_RXF0 + (id % 4) * 4
+        self.rx_dreq = (id // 4) * 8 + 4 + id % 4
+        self.dma = None
+        self.dma_rewind = None
+        self.dma_write_addr = 0
+        self.last_frame_end = -1
+
+        # The newest reading is decoded into one half of frames while the
+        # other half holds the previous one; front selects the complete half.
+        self.frames = array('H', [TIMEOUT] * (2 * SENSOR_COUNT))
+        self.front = 0
+
+        self.frame_info = array('i', [0, 0, STATUS_STALE])
+        self.start_us = ticks_us()
+        self.frame_seen_us = self.start_us
+
+        # Instructions that set the pins back to inputs when the program is
+        # stopped, since it may have started charging them for the next
+        # reading.
+        self.release_instrs = array('H')
+        self.release_instrs.append(rp2.asm_pio_encode("mov(osr, null)", 0))
+        self.release_instrs.append(rp2.asm_pio_encode("out(pindirs, 5)", 0))
+
+    def stop(self):
+        self.sm.active(0)
+        for instr in self.release_instrs:
+            self.sm.exec(instr)
 
     def run(self):
         self.sm.active(0)
         while self.sm.rx_fifo():
             self.sm.get()
         self.sm.restart()
-        for instr in self.pio_instrs:
-            self.sm.exec(instr)
+        self.start_us = ticks_us()
+        self.sm.active(1)
+
+    def start_continuous(self):
+        self.stop_continuous()
+        self.sm.active(0)
+        while self.sm.rx_fifo():
+            self.sm.get()
+        self.sm.restart()
+
+        for i in range(RING_SIZE):
+            self.ring[i] = _EMPTY
+        self.last_frame_end = -1
+
+        self.dma = DMA()
+        self.dma_rewind = DMA()
+        self.dma_write_addr = _DMA_BASE + self.dma.channel * 0x40 + _DMA_WRITE_ADDR
+        self.dma_rewind.config(
+            read=self.ring_start,
+            write=_DMA_BASE + self.dma.channel * 0x40 + _DMA_AL2_WRITE_ADDR_TRIG,
+            count=1,
+            ctrl=self.dma_rewind.pack_ctrl(inc_read=False, inc_write=False))
+        self.dma.config(
+            read=self.rx_fifo_addr,
+            write=self.ring,
+            count=RING_SIZE,
+            ctrl=self.dma.pack_ctrl(inc_read=False, treq_sel=self.rx_dreq,
+                                    chain_to=self.dma_rewind.channel),
+            trigger=True)
         self.sm.active(1)
 
+        # Wait for the first reading so that read_continuous() has data.
+        self.frame_info[FRAME_STATUS] = STATUS_STALE
+        start = ticks_us()
+        while self.frame_info[FRAME_STATUS] != STATUS_OK:
+            if (ticks_us() - start) & _TICKS_MAX > _READ_TIMEOUT_US:
+                break
+            self.read_continuous()
+
+    def stop_continuous(self):
+        if not self.dma:
+            return
+        self.stop()
+        # Stop the rewind channel first so that it cannot restart the data
+        # channel.
+        self.dma_rewind.active(0)
+        self.dma.active(0)
+        self.dma_rewind.close()
+        self.dma.close()
+        self.dma = None
+        self.dma_rewind = None
+        while self.sm.rx_fifo():
+            self.sm.get()
+
     @micropython.viper
     def read_line(self):
         last_states = uint(0x7f0000)
@@ -120,7 +237,14 @@ class QTRSensors:
             data[i] = TIMEOUT
 
         sm = self.sm
-        while True:  # TODO: TIMEOUT?
+        start = int(self.start_us)
+        status = STATUS_OK
+        while True:
+            if not sm.rx_fifo():
+                if (int(ticks_us()) - start) & _TICKS_MAX > _READ_TIMEOUT_US:
+                    status = STATUS_PARTIAL
+                    break
+                continue
             val = uint(sm.get())
             if(val == uint(0xffffffff)):
                 break
@@ -136,6 +260,96 @@ class QTRSensors:
             if new_zeros & 0x100000:
                 data[0] = TIMEOUT - val
             last_states = val
+        self.stop()
+
+        info = ptr32(self.frame_info)
+        age = ((int(ticks_us()) - start) & _TICKS_MAX) - _READ_US
+        info[FRAME_SEQ] += 1
+        info[FRAME_AGE_US] = age if age > 0 else 0
+        info[FRAME_STATUS] = status
+        return self.data_line
+
+    @micropython.viper
+    def decode_newest(self) -> int:
+        # Decodes the most recent complete reading in the ring buffer into the
+        # back half of frames and makes it the front half.  Returns 1 if that
+        # reading is newer than the last one decoded, or 0 if there is nothing
+        # new.
+        ring = ptr32(self.ring)
+        done = uint(0xffffffff)
+        empty = uint(_EMPTY)
+        next_word = int((uint(ptr32(self.dma_write_addr)[0]) - uint(ring)) >> 2)
+
+        # Find the marker at the end of the newest reading.
+        end = next_word
+        n = 0
+        while True:
+            end = (end - 1) & (RING_SIZE - 1)
+            n += 1
+            if uint(ring[end]) == done:
+                break
+            if n >= RING_SIZE or uint(ring[end]) == empty:
+                return 0
+        if end == int(self.last_frame_end):
+            return 0
+
+        # Find where that reading started.
+        start = end
+        while True:
+            start = (start - 1) & (RING_SIZE - 1)
+            n += 1
+            if uint(ring[start]) == done or uint(ring[start]) == empty:
+                break
+            if n >= RING_SIZE:
+                return 0
+
+        back = 1 - int(self.front)
+        b = back * SENSOR_COUNT
+        last_states = uint(0x7f0000)
+        data = ptr16(self.frames)
+        for i in range(5):
+            data[b + i] = TIMEOUT
+
+        i = (start + 1) & (RING_SIZE - 1)
+        while i != end:
+            val = uint(ring[i])
+            new_zeros = last_states ^ val
+            if new_zeros & 0x10000:
+                data[b + 4] = TIMEOUT - val
+            if new_zeros & 0x20000:
+                data[b + 3] = TIMEOUT - val
+            if new_zeros & 0x40000:
+                data[b + 2] = TIMEOUT - val
+            if new_zeros & 0x80000:
+                data[b + 1] = TIMEOUT - val
+            if new_zeros & 0x100000:
+                data[b + 0] = TIMEOUT - val
+            last_states = val
+            i = (i + 1) & (RING_SIZE - 1)
+
+        self.last_frame_end = end
+        self.front = back
+        return 1
+
+    @micropython.viper
+    def read_continuous(self):
+        # The time a reading finished is not recorded, so its age is measured
+        # from when it was first decoded.
+        now = int(ticks_us())
+        info = ptr32(self.frame_info)
+        if self.decode_newest():
+            self.frame_seen_us = now
+            info[FRAME_SEQ] += 1
+            info[FRAME_STATUS] = STATUS_OK
+        else:
+            info[FRAME_STATUS] = STATUS_STALE
+        info[FRAME_AGE_US] = (now - int(self.frame_seen_us)) & _TICKS_MAX
+
+        frame = ptr16(self.frames)
+        front = int(self.front) * SENSOR_COUNT
+        data = ptr16(self.data_line)
+        for i in range(5):
+            data[i] = frame[front + i]
         return self.data_line
 
 class _IRSensors():
@@ -146,42 +360,148 @@ class _IRSensors():
         if not _qtr:
             _qtr = QTRSensors(4, 18)
         self.qtr = _qtr
+        self.frame_info = _qtr.frame_info
+        self._emitters_on = True
 
         self.reset_calibration()
 
 class LineSensors(_IRSensors):
+    def __init__(self):
+        super().__init__()
+        self._cancel_ambient = False
+        self.on_data = array('H', [TIMEOUT] * 5)
+        self.off_data = array('H', [TIMEOUT] * 5)
+        self.ambient_data = array('H', [TIMEOUT] * 5)
+
     def _state(self):
         # for testing
         return _state
 
+    def cancel_ambient(self, cancel):
+        # When enabled, calibrate() and read_calibrated() use
+        # read_ambient_cancelled() instead of read().
+        if not cancel and _state == _READ_LINE:
+            # Finish the reading read_ambient_cancelled() left running.
+            self._finish_read()
+        self._cancel_ambient = cancel
+
     def reset_calibration(self):
+        self.last_position = 0
         self.cal_min = array('H', [1025] * 5)
         self.cal_max = array('H', [0] * 5)
+        self.cal_histogram = array('H', [0] * (5 * _BIN_COUNT))
 
     def calibrate(self):
-        tmp_min = array('H', [1025] * 5)
-        tmp_max = array('H', [0] * 5)
-
         # do 10 measurements
         for trials in range(10):
-            data = self.read()
-            for i in range(5):
-                tmp_min[i] = min(data[i], tmp_min[i])
-                tmp_max[i] = max(data[i], tmp_max[i])
+            data = self.read_ambient_cancelled() if self._cancel_ambient else self.read()
+            self._add_calibration_sample(data)
+        self._update_calibration()
 
-        # update data only if ALL data beyond one of the limits
+    @micropython.viper
+    def _add_calibration_sample(self, data):
+        d = ptr16(data)
+        hist = ptr16(self.cal_histogram)
+        for i in range(5):
+            first = i * _BIN_COUNT
+            b = first + (int(d[i]) >> _BIN_SHIFT)
+            if int(hist[b]) == 0xffff:
+                # Halve this sensor's histogram to make room; this keeps its
+                # shape, which is all that matters.
+                for j in range(first, first + _BIN_COUNT):
+                    hist[j] = int(hist[j]) >> 1
+            hist[b] = int(hist[b]) + 1
+
+    @micropython.viper
+    def _update_calibration(self):
+        # Set the limits to the percentiles of the readings so far, so that a
+        # few noisy readings cannot widen the range.
+        hist = ptr16(self.cal_histogram)
+        cal_min = ptr16(self.cal_min)
+        cal_max = ptr16(self.cal_max)
         for i in range(5):
-            self.cal_max[i] = max(tmp_min[i], self.cal_max[i])
-            self.cal_min[i] = min(tmp_max[i], self.cal_min[i])
+            first = i * _BIN_COUNT
+            last = first + _BIN_COUNT - 1
+            total = 0
+            for j in range(first, last + 1):
+                total += int(hist[j])
+            if total == 0:
+                continue
+            reject = total * _REJECT_PER_MILLE // 1000
+
+            count = 0
+            b = first
+            while True:
+                count += int(hist[b])
+                if count > reject:
+                    break
+                b += 1
+            cal_min[i] = (b - first) << _BIN_SHIFT
+
+            count = 0
+            b = last
+            while True:
+                count += int(hist[b])
+                if count > reject:
+                    break
+                b -= 1
+            top = ((b - first + 1) << _BIN_SHIFT) - 1
+            cal_max[i] = top if top < TIMEOUT else TIMEOUT
+
+    def save_calibration(self, filename=CALIBRATION_FILE):
+        with open(filename, 'wb') as f:
+            f.write(self.cal_min)
+            f.write(self.cal_max)
+
+    def load_calibration(self, filename=CALIBRATION_FILE):
+        # Returns True if a complete calibration was loaded.
+        cal_min = array('H', [1025] * 5)
+        cal_max = array('H', [0] * 5)
+        try:
+            with open(filename, 'rb') as f:
+                if f.readinto(cal_min) != 10 or f.readinto(cal_max) != 10:
+                    return False
+        except OSError:
+            return False
+        self.cal_min = cal_min
+        self.cal_max = cal_max
+        return True
 
     def start_read(self, emitters_on=True):
         global _state
+        if _state == _CONTINUOUS:
+            return
         if emitters_on: self.ir_down.init(Pin.OUT, value=1)
+        self._emitters_on = emitters_on
         _state = _READ_LINE
         self.qtr.run()
 
+    def start_continuous(self):
+        # Take readings back-to-back in the background with the emitters on.
+        # read() then returns the newest complete reading without waiting.
+        global _state
+        self.ir_down.init(Pin.OUT, value=1)
+        _state = _CONTINUOUS
+        self.qtr.start_continuous()
+
+    def stop_continuous(self):
+        global _state
+        self.qtr.stop_continuous()
+        self.ir_down.init(Pin.IN)
+        _state = _DONE
+
     @micropython.viper
     def read(self):
+        if uint(_state) == uint(_CONTINUOUS):
+            return self.qtr.read_continuous()
+        if uint(_state) == uint(_READ_LINE) and not bool(self._emitters_on):
+            # read_ambient_cancelled() left a reading with the emitters off
+            # running; discard it and take a fresh one.
+            self._finish_read()
+        return self._finish_read()
+
+    @micropython.viper
+    def _finish_read(self):
         global _state
         if uint(_state) != uint(_READ_LINE):
             self.start_read()
@@ -191,9 +511,47 @@ class LineSensors(_IRSensors):
         _state = _DONE
         return data
 
+    def read_ambient_cancelled(self):
+        # Alternates readings with the emitters on and off, always starting
+        # the next one before returning so that it runs while the caller is
+        # busy.  Each call combines the newest reading of each kind, so there
+        # is a new result after every reading instead of every other one.
+        if _state == _CONTINUOUS:
+            raise ValueError("Ambient cancelling is not available in continuous mode")
+        if _state != _READ_LINE:
+            # Nothing is in progress, so take a reading with the emitters off
+            # first.
+            self.start_read(emitters_on=False)
+            self._combine_ambient(self._finish_read(), False)
+            self.start_read(emitters_on=True)
+        emitters_on = self._emitters_on
+        data = self._finish_read()
+        self.start_read(emitters_on=not emitters_on)
+        return self._combine_ambient(data, emitters_on)
+
+    @micropython.viper
+    def _combine_ambient(self, data, emitters_on: bool):
+        # Add back the light that reached the sensors with the emitters off,
+        # the same correction used by Pololu's QTR libraries.
+        d = ptr16(data)
+        on = ptr16(self.on_data)
+        off = ptr16(self.off_data)
+        result = ptr16(self.ambient_data)
+        for i in range(5):
+            if emitters_on:
+                on[i] = d[i]
+            else:
+                off[i] = d[i]
+            value = int(on[i]) + TIMEOUT - int(off[i])
+            result[i] = value if value < TIMEOUT else TIMEOUT
+        return self.ambient_data
+
     @micropython.viper
     def read_calibrated(self):
-        data = self.read()
+        if self._cancel_ambient:
+            data = self.read_ambient_cancelled()
+        else:
+            data = self.read()
         d = ptr16(data)
         cal_min = ptr16(self.cal_min)
         cal_max = ptr16(self.cal_max)
@@ -205,3 +563,43 @@ class LineSensors(_IRSensors):
             else:
                d[i] = (d[i] - cal_min[i])*1000 // (cal_max[i] - cal_min[i])
         return data
+
+    def read_line_position(self, white_line=False):
+        # Returns an estimate of the position of the line from 0 (under
+        # sensor 0) to 4000 (under sensor 4), interpolating between sensors
+        # with a weighted average of the calibrated readings.  If no sensor
+        # sees the line, returns 0 or 4000 depending on which side it was last
+        # seen on.
+        return self._read_line_position(white_line)
+
+    # Viper functions do not support default arguments.
+    @micropython.viper
+    def _read_line_position(self, white_line) -> int:
+        d = ptr16(self.read_calibrated())
+        avg = 0
+        total = 0
+        on_line = False
+        for i in range(5):
+            value = int(d[i])
+            if white_line:
+                value = 1000 - value
+
+            # keep track of whether we see the line at all
+            if value > 200:
+                on_line = True
+
+            # only average in values that are above a noise threshold
+            if value > 50:
+                avg += value * i * 1000
+                total += value
+
+        if not on_line:
+            # if it last read to the left of center, return 0
+            if int(self.last_position) < 2000:
+                return 0
+            # if it last read to the right of center, return the max
+            return 4000
+
+        position = avg // total
+        self.last_position = position
+        return position
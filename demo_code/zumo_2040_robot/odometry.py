@@ -0,0 +1,117 @@
+import math
+from array import array
+from machine import Timer
+from time import ticks_us, ticks_diff
+
+DEFAULT_FREQ = const(100)
+
+# The 75:1 motors give about 909.7 counts per revolution of the drive
+# sprockets, which move the tracks about 122 mm per revolution.
+DEFAULT_COUNTS_PER_MM = 7.45
+DEFAULT_TRACK_WIDTH_MM = 85
+
+class Odometry:
+    """Keeps track of the robot's position and heading in the background,
+    using the encoders for distance and blending the encoders and gyro for
+    heading.
+
+    This does not read the gyro itself: it uses gyro.last_reading_dps, so
+    keep that up to date with IMU.start_sampling() or by reading the IMU
+    yourself.  With gyro set to None, the heading comes from the encoders
+    alone."""
+    def __init__(self, encoders, gyro, freq=DEFAULT_FREQ,
+                 counts_per_mm=DEFAULT_COUNTS_PER_MM,
+                 track_width_mm=DEFAULT_TRACK_WIDTH_MM):
+        self.encoders = encoders
+        self.gyro = gyro
+        self.freq = freq
+        self.counts_per_mm = counts_per_mm
+        self.track_width_mm = track_width_mm
+
+        # How much to trust the gyro over the encoders for changes in
+        # heading.  The tracks slip when turning, but the gyro drifts.
+        self.gyro_weight = 0.98
+
+        # x and y in mm, theta in radians counterclockwise.  _seq is odd
+        # while the state is being updated, so readers can tell if they got
+        # a torn copy without taking a lock.
+        self._state = array('f', [0, 0, 0])
+        self._seq = 0
+
+        self._counts = array('i', [0, 0])
+        self._last_left = 0
+        self._last_right = 0
+        self._last_time = 0
+
+        self._timer = None
+        self._callback = self._update # bind once so the timer does not allocate
+
+    def start(self):
+        self.encoders.read_counts(self._counts)
+        self._last_left = self._counts[0]
+        self._last_right = self._counts[1]
+        self._last_time = ticks_us()
+        self._timer = Timer(freq=self.freq, mode=Timer.PERIODIC,
+                            callback=self._callback)
+
+    def stop(self):
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+
+    def reset(self, x=0, y=0, theta=0):
+        self._seq += 1
+        self._state[0] = x
+        self._state[1] = y
+        self._state[2] = theta
+        self._seq += 1
+
+    @micropython.viper
+    def _copy(self, buf):
+        src = ptr32(self._state)
+        dst = ptr32(buf)
+        for i in range(3):
+            dst[i] = src[i]
+
+    def read(self, buf):
+        # Copies x, y and theta into buf, an array('f', 3).  This is safe to
+        # call from either core while the odometry is updating.
+        while True:
+            seq = self._seq
+            if seq & 1:
+                continue
+            self._copy(buf)
+            if self._seq == seq:
+                return buf
+
+    def get_pose(self):
+        # Returns x and y in mm and the heading in degrees.
+        buf = self.read(array('f', [0, 0, 0]))
+        return buf[0], buf[1], math.degrees(buf[2])
+
+    def _update(self, t):
+        counts = self._counts
+        self.encoders.read_counts(counts)
+        now = ticks_us()
+        dt = ticks_diff(now, self._last_time) / 1000000
+        left = (counts[0] - self._last_left) / self.counts_per_mm
+        right = (counts[1] - self._last_right) / self.counts_per_mm
+        self._last_left = counts[0]
+        self._last_right = counts[1]
+        self._last_time = now
+
+        # Complementary filter on the change in heading.
+        turn = (right - left) / self.track_width_mm
+        rate = self.gyro.last_reading_dps[2] if self.gyro else None
+        if rate is not None:
+            w = self.gyro_weight
+            turn = w * math.radians(rate) * dt + (1 - w) * turn
+        distance = (left + right) / 2
+
+        state = self._state
+        heading = state[2] + turn / 2
+        self._seq += 1
+        state[0] += distance * math.cos(heading)
+        state[1] += distance * math.sin(heading)
+        state[2] += turn
+        self._seq += 1
@@ -0,0 +1,134 @@
+import math
+from array import array
+from time import ticks_us, ticks_diff
+
+_DEG_TO_RAD = math.pi / 180
+
+class OrientationFilter:
+    """Tracks the robot's orientation as a quaternion from the IMU readings
+    using Mahony's filter."""
+    def __init__(self, imu, use_mag=False):
+        self.imu = imu
+        self.use_mag = use_mag
+
+        # Gains of the feedback from the accelerometer (and magnetometer)
+        # that corrects the gyro's drift; ki also learns its bias.
+        self.kp = 1.0
+        self.ki = 0.0
+
+        # w, x, y, z
+        self.q = array('f', [1, 0, 0, 0])
+        self._integral = array('f', [0, 0, 0])
+        self._last_time = None
+        self._count = 0
+
+    def reset(self):
+        self.q[0] = 1
+        for i in range(3):
+            self.q[i + 1] = 0
+            self._integral[i] = 0
+        self._last_time = None
+
+    def update(self, read=True):
+        # Reads the IMU (unless read is False) and updates the orientation.
+        # Call this at the gyro's output data rate.  While the IMU's
+        # start_sampling() is running, this uses its readings and the times
+        # they arrived instead, and does nothing until there is a new one.
+        times = self.imu.gyro_times
+        if times.running:
+            if times.count == self._count:
+                return
+            self._count = times.count
+            now = times.last_time()
+        else:
+            if read:
+                if self.use_mag:
+                    self.imu.read()
+                else:
+                    self.imu.read_gyro_acc()
+            now = ticks_us()
+        if self._last_time is None:
+            self._last_time = now
+            return
+        dt = ticks_diff(now, self._last_time) * 0.000001
+        self._last_time = now
+
+        g = self.imu.gyro.last_reading_dps
+        a = self.imu.acc.last_reading_g
+        if self.use_mag:
+            m = self.imu.mag.last_reading_gauss
+            self._step(g[0] * _DEG_TO_RAD, g[1] * _DEG_TO_RAD, g[2] * _DEG_TO_RAD,
+                       a[0], a[1], a[2], m[0], m[1], m[2], dt)
+        else:
+            self._step(g[0] * _DEG_TO_RAD, g[1] * _DEG_TO_RAD, g[2] * _DEG_TO_RAD,
+                       a[0], a[1], a[2], 0, 0, 0, dt)
+
+    @micropython.native
+    def _step(self, gx, gy, gz, ax, ay, az, mx, my, mz, dt):
+        q = self.q
+        q0 = q[0]; q1 = q[1]; q2 = q[2]; q3 = q[3]
+
+        norm = ax * ax + ay * ay + az * az
+        if norm > 0:
+            norm = 1 / math.sqrt(norm)
+            ax *= norm; ay *= norm; az *= norm
+
+            # Half the direction of gravity expected from the orientation,
+            # and the error between that and the accelerometer.
+            vx = q1 * q3 - q0 * q2
+            vy = q0 * q1 + q2 * q3
+            vz = q0 * q0 - 0.5 + q3 * q3
+            ex = ay * vz - az * vy
+            ey = az * vx - ax * vz
+            ez = ax * vy - ay * vx
+
+            norm = mx * mx + my * my + mz * mz
+            if norm > 0:
+                norm = 1 / math.sqrt(norm)
+                mx *= norm; my *= norm; mz *= norm
+
+                # The direction of the earth's field, from the reading
+                # rotated into the earth frame, then back again.
+                hx = 2 * (mx * (0.5 - q2 * q2 - q3 * q3) + my * (q1 * q2 - q0 * q3) + mz * (q1 * q3 + q0 * q2))
+                hy = 2 * (mx * (q1 * q2 + q0 * q3) + my * (0.5 - q1 * q1 - q3 * q3) + mz * (q2 * q3 - q0 * q1))
+                bx = math.sqrt(hx * hx + hy * hy)
+                bz = 2 * (mx * (q1 * q3 - q0 * q2) + my * (q2 * q3 + q0 * q1) + mz * (0.5 - q1 * q1 - q2 * q2))
+                wx = bx * (0.5 - q2 * q2 - q3 * q3) + bz * (q1 * q3 - q0 * q2)
+                wy = bx * (q1 * q2 - q0 * q3) + bz * (q0 * q1 + q2 * q3)
+                wz = bx * (q0 * q2 + q1 * q3) + bz * (0.5 - q1 * q1 - q2 * q2)
+                ex += my * wz - mz * wy
+                ey += mz * wx - mx * wz
+                ez += mx * wy - my * wx
+
+            if self.ki > 0:
+                i = self._integral
+                k = 2 * self.ki * dt
+                i[0] += k * ex; i[1] += k * ey; i[2] += k * ez
+                gx += i[0]; gy += i[1]; gz += i[2]
+            k = 2 * self.kp
+            gx += k * ex; gy += k * ey; gz += k * ez
+
+        # Integrate the rate of change of the quaternion.
+        gx *= 0.5 * dt; gy *= 0.5 * dt; gz *= 0.5 * dt
+        w = q0 - q1 * gx - q2 * gy - q3 * gz
+        x = q1 + q0 * gx + q2 * gz - q3 * gy
+        y = q2 + q0 * gy - q1 * gz + q3 * gx
+        z = q3 + q0 * gz + q1 * gy - q2 * gx
+        norm = 1 / math.sqrt(w * w + x * x + y * y + z * z)
+        q[0] = w * norm; q[1] = x * norm; q[2] = y * norm; q[3] = z * norm
+
+    def roll(self):
+        q = self.q
+        return math.degrees(math.atan2(q[0] * q[1] + q[2] * q[3], 0.5 - q[1] * q[1] - q[2] * q[2]))
+
+    def pitch(self):
+        q = self.q
+        s = 2 * (q[0] * q[2] - q[1] * q[3])
+        if s > 1: s = 1
+        if s < -1: s = -1
+        return math.degrees(math.asin(s))
+
+    def yaw(self):
+        # Counterclockwise, seen from above.
+        q = self.q
+        return math.degrees(math.atan2(q[1] * q[2] + q[0] * q[3], 0.5 - q[2] * q[2] - q[3] * q[3]))
@@ -1,78 +1,216 @@
 from array import array
-from machine import Pin, PWM
-from time import sleep_us
+from machine import Pin
+import rp2
+from rp2 import PIO, DMA
 
 DEFAULT_FREQ = const(56000)
 DEFAULT_BRIGHTNESS_LEVELS = [313, 1000, 2063, 3500, 5375, 7563]
 
-_ir_pulses = None
+# According to the TSSP770 datasheet, the delay between the start of the IR
+# pulses and the start of the sensor output pulse could be anywhere between
+# 7/freq and 13/freq.
+#
+# The pulse on time of 14/freq (250 us for 56 kHz) guarantees we are not
+# missing output pulses by reading the sensor too soon.
+_ON_PERIODS = const(14)
+
+# According to the TSSP770 datasheet, the sensor output pulse duration could be
+# up to 4/freq longer than the duration of the IR pulses, and the sensor output
+# pulse could start as late as 13/freq after the IR pulses start.  Therefore,
+# it is possible for the sensor output pulse to end up to 17/freq after the
+# ending of the IR pulses.
+#
+# So the off time is 18/freq (321 us for 56 kHz).
+_OFF_PERIODS = const(18)
+
+# The PIO program runs at a fixed rate and the length of each carrier period is
+# set per step, so one reading can mix frequencies.  This gives 256 cycles per
+# period at 56 kHz.  The off time of each period is at most 516 cycles, so
+# frequencies down to ~27.6 kHz work at any brightness.
+_PIO_FREQ = const(14336000)
+
+# Bits in the pin states sampled by the PIO program, starting at GPIO 23.
+_LEFT_SENSOR_BIT = const(0x01)
+_RIGHT_SENSOR_BIT = const(0x02)
+_FRONT_SENSOR_BIT = const(0x10)
+
+# Offsets of each sensor's counts in ProximitySensors.counts.
+# The counts are bytes, so a reading can have at most this many pulses on
+# each side.
+_MAX_PULSES = const(255)
+
+_LEFT = const(0)
+_FRONT = const(2)
+_RIGHT = const(4)
+
+# Values for the LED mask, starting at GPIO 16.
+_LEFT_LEDS = const(0b10)
+_RIGHT_LEDS = const(0b01)
+
+_PIO0_BASE = const(0x50200000)
+_PIO_TXF0 = const(0x10)
+_PIO_RXF0 = const(0x20)
+
+_pulses = None
 
 class IRPulses:
-    def __init__(self):
-        self.left_pulses_pin = Pin(17, Pin.OUT, value=0)
-        self.right_pulses_pin = Pin(16, Pin.OUT, value=0)
-        self.left_pulses_pwm = PWM(self.left_pulses_pin, freq=DEFAULT_FREQ, duty_ns=0)
-        self.right_pulses_pwm = PWM(self.right_pulses_pin, freq=DEFAULT_FREQ, duty_ns=0)
-
-    def set_frequency(self, freq):
-        # Normally, only one of the below calls should be necessary since the
-        # default pins are on the same PWM slice (16 and 17 = 0A and 0B), but
-        # we'll go ahead and do both in case different pins are in use.
-        self.left_pulses_pwm.freq(freq)
-        self.right_pulses_pwm.freq(freq)
-
-        # TODO: limit or reset duty cycle (brightness) if out of range?
-
-    def set_brightnesses(self, left, right):
-        self.left_pulses_pwm.duty_ns(left)
-        self.right_pulses_pwm.duty_ns(right)
-
-    def set_left_brightness(self, brightness):
-        self.left_pulses_pwm.duty_ns(brightness)
-
-    def set_right_brightness(self, brightness):
-        self.right_pulses_pwm.duty_ns(brightness)
-
-    def off(self):
-        self.set_brightnesses(0, 0)
+    """Generates IR pulses and samples the proximity sensors using PIO"""
+    @rp2.asm_pio(
+        out_init=(PIO.OUT_LOW,) * 2,
+        out_shiftdir=PIO.SHIFT_RIGHT,
+        autopush=True, # push each sample as soon as it is taken
+        push_thresh=5
+        )
+    def scanner():
+        # The CPU sends one word for each step of a reading:
+        #   bits 0-7:   number of carrier periods - 1
+        #   bits 8-9:   which LEDs to pulse
+        #   bits 10-18: cycles the LEDs are on in each period - 3
+        #   bits 19-20: zeros, to turn the LEDs off
+        #   bits 21-29: cycles the LEDs are off in each period - 5
+        # so the length of each period depends only on the frequency.
+        pull(block)
+        out(y, 8)
+
+        # Keep the rest of the word in ISR so it can be reloaded each period.
+        mov(isr, osr)
+
+        label("period")
+        mov(osr, isr)
+        out(pins, 2)
+        out(x, 9)
+        label("high")
+        jmp(x_dec, "high")
+        out(pins, 2)
+        out(x, 9)
+        label("low")
+        jmp(x_dec, "low")
+        jmp(y_dec, "period")
+
+        # Sample the sensors at the end of the step.  The low 5 bits of the
+        # pushed word hold GPIO 23-27.
+        in_(pins, 5)
+
+    def __init__(self, id, pulses_pin, sensors_pin):
+        self.sm = rp2.StateMachine(id, self.scanner, freq=_PIO_FREQ,
+                                   out_base=Pin(pulses_pin, Pin.OUT, value=0),
+                                   in_base=Pin(sensors_pin, Pin.IN))
+        self.sm.active(1)
+
+        base = _PIO0_BASE + (id // 4) * 0x100000
+        self.tx_fifo_addr = base + _PIO_TXF0 + (id % 4) * 4
+        self.rx_fifo_addr = base + _PIO_RXF0 + (id % 4) * 4
+        self.tx_dreq = (id // 4) * 8 + id % 4
+        self.rx_dreq = self.tx_dreq + 4
+        self.dma_tx = DMA()
+        self.dma_rx = DMA()
+
+        self.steps = array('I')
+        self.results = array('I')
+
+    def _step(self, periods, leds, freq, brightness):
+        # brightness is the on time of each period in ns.
+        cycles = _PIO_FREQ // freq
+        high = brightness * (_PIO_FREQ // 1000) // 1000000
+        if high < 3: high = 3
+        if high > cycles - 5: high = cycles - 5
+        low = cycles - high
+        if high - 3 > 0x1ff:
+            raise ValueError(f"Invalid brightness: {brightness}")
+        if low - 5 > 0x1ff:
+            raise ValueError(f"Invalid frequency: {freq}")
+        return (periods - 1) | leds << 8 | (high - 3) << 10 | (low - 5) << 21
+
+    def set_profile(self, profile):
+        # profile is a list of (frequency, brightness) pulses.  Each is
+        # pulsed on the left LEDs, then on the right LEDs, and each pulse is
+        # followed by an off time.
+        self.steps = array('I', [0] * (4 * len(profile)))
+        self.results = array('I', [0] * len(self.steps))
+        i = 0
+        for freq, brightness in profile:
+            for leds in (_LEFT_LEDS, _RIGHT_LEDS):
+                self.steps[i] = self._step(_ON_PERIODS, leds, freq, brightness)
+                self.steps[i + 1] = self._step(_OFF_PERIODS, 0, freq, 0)
+                i += 2
+
+    def start(self):
+        while self.sm.rx_fifo():
+            self.sm.get()
+        count = len(self.steps)
+        self.dma_rx.config(
+            read=self.rx_fifo_addr,
+            write=self.results,
+            count=count,
+            ctrl=self.dma_rx.pack_ctrl(inc_read=False, treq_sel=self.rx_dreq),
+            trigger=True)
+        self.dma_tx.config(
+            read=self.steps,
+            write=self.tx_fifo_addr,
+            count=count,
+            ctrl=self.dma_tx.pack_ctrl(inc_write=False, treq_sel=self.tx_dreq),
+            trigger=True)
+
+    def done(self):
+        return not self.dma_rx.active()
 
 
 class ProximitySensors:
     def __init__(self):
-        global _ir_pulses
-        if not _ir_pulses:
-            _ir_pulses = IRPulses()
-        self.ir_pulses = _ir_pulses
-
-        self.set_frequency(DEFAULT_FREQ)
-        self.brightness_levels = DEFAULT_BRIGHTNESS_LEVELS
+        global _pulses
+        if not _pulses:
+            _pulses = IRPulses(5, 16, 23)
+        self.ir_pulses = _pulses
 
         self.left_sensor = Pin(23, Pin.IN)
         self.right_sensor = Pin(24, Pin.IN)
         self.front_sensor = Pin(27, Pin.IN)
 
         self.sensors = [self.left_sensor, self.front_sensor, self.right_sensor]
-        self.counts = [array('B', [0, 0]) for _ in range(len(self.sensors))]
+
+        # Counts for each sensor, with the left LEDs then the right LEDs.
+        self.counts = bytearray(2 * len(self.sensors))
+
+        self.frequency = DEFAULT_FREQ
+        self.brightness_levels = list(DEFAULT_BRIGHTNESS_LEVELS)
+        self.profile = None
+        # a copy of brightness_levels from when the steps were built
+        self._levels = None
+        self._pulse_count = len(self.brightness_levels)
+
+        self._started = False
+        self._counted = True
 
     def set_frequency(self, freq):
-        self.ir_pulses.set_frequency(freq)
-
-        # According to the TSSP770 datasheet, the delay between the start of the
-        # IR pulses and the start of the sensor output pulse could be anywhere
-        # between 7/freq and 13/freq.
-        #
-        # The default pulse on time of 14/freq (250 us for 56 kHz) guarantees we
-        # are not missing output pulses by reading the sensor too soon.
-        self.pulse_on_time_us = 14 * 1000000 // freq
-
-        # According to the TSSP770 datasheet, the sensor output pulse duration
-        # could be up to 4/freq longer than the duration of the IR pulses, and
-        # the sensor output pulse could start as late as 13/freq after the IR
-        # pulses start.  Therefore, it is possible for the sensor output pulse
-        # to end up to 17/freq after the ending of the IR pulses.
-        #
-        # So the default off time is 18/freq (321 us for 56 kHz).
-        self.pulse_off_time_us = 18 * 1000000 // freq
+        self.frequency = freq
+        self._levels = None # rebuild the steps at the next reading
+
+    def set_scan_profile(self, profile):
+        # Sets the pulses used for each reading as a list of (frequency,
+        # brightness) pairs.  Brightness is the on time of each carrier
+        # period in ns.  Mixing frequencies gives more, finer steps between
+        # the weakest and strongest pulses, since the sensors are less
+        # sensitive away from their center frequency.  Pass None to go back
+        # to using brightness_levels at a single frequency.
+        if profile is not None and len(profile) > _MAX_PULSES:
+            raise ValueError(f"Too many pulses: {len(profile)}")
+        self.profile = profile
+        self._levels = None
+
+    def _get_profile(self):
+        if self.profile is not None:
+            return self.profile
+        return [(self.frequency, b) for b in self.brightness_levels]
+
+    def pulse_count(self):
+        # The number of pulses on each side in the last reading, which is
+        # also the largest possible count.
+        return self._pulse_count
+
+    def scan_time_us(self):
+        # How long a reading takes.
+        return sum(2 * (_ON_PERIODS + _OFF_PERIODS) * 1000000 // freq
+                   for freq, _ in self._get_profile())
 
     def _prepare_to_read(self):
         # pull-ups on
@@ -80,61 +218,136 @@ class ProximitySensors:
         self.right_sensor.init(Pin.IN, Pin.PULL_UP)
         self.front_sensor.init(Pin.IN, Pin.PULL_UP)
 
-    def read(self):
+    def start_read(self):
+        # Starts a reading in the background; the PIO program times the
+        # pulses and DMA feeds it, so no CPU time is used until ready()
+        # or read() collects the counts.
+        if self._started:
+            return
+        # brightness_levels can be changed in place, so compare its contents
+        # with the copy taken when the steps were built.
+        if self._levels is None or self._levels != self.brightness_levels:
+            profile = self._get_profile()
+            if len(profile) > _MAX_PULSES:
+                raise ValueError(f"Too many pulses: {len(profile)}")
+            self.ir_pulses.set_profile(profile)
+            self._pulse_count = len(profile)
+            self._levels = self.brightness_levels[:]
         self._prepare_to_read()
+        self._started = True
+        self._counted = False
+        self.ir_pulses.start()
+
+    def ready(self):
+        # Returns True once the counts from the last reading are available.
+        if not self._counted:
+            if not self.ir_pulses.done():
+                return False
+            self._count()
+            self._counted = True
+        return True
 
-        self.counts = [array('B', [0, 0]) for _ in range(len(self.sensors))]
-
-        for brightness in self.brightness_levels:
-            self.ir_pulses.set_brightnesses(brightness, 0)
-            sleep_us(self.pulse_on_time_us)
-            for sensor, counts in zip(self.sensors, self.counts):
-                if not sensor.value(): counts[0] += 1
-
-            self.ir_pulses.off()
-            sleep_us(self.pulse_off_time_us)
-
-            self.ir_pulses.set_brightnesses(0, brightness)
-            sleep_us(self.pulse_on_time_us)
-            for sensor, counts in zip(self.sensors, self.counts):
-                if not sensor.value(): counts[1] += 1
-
-            self.ir_pulses.off()
-            sleep_us(self.pulse_off_time_us)
+    def read(self):
+        # Finishes the reading started by start_read(), or takes a new one.
+        if not self._started:
+            self.start_read()
+        while not self.ready():
+            pass
+        self._started = False
+
+    def read_into(self, buf):
+        # Finishes the reading like read(), then copies the counts into buf,
+        # which must hold 6 bytes: left, front and right sensors, each with
+        # the left LEDs then the right LEDs.
+        self.read()
+        self._copy_counts(buf)
+
+    @micropython.viper
+    def _copy_counts(self, buf):
+        counts = ptr8(self.counts)
+        b = ptr8(buf)
+        for i in range(6):
+            b[i] = counts[i]
+
+    @micropython.viper
+    def _count(self):
+        results = ptr32(self.ir_pulses.results)
+        counts = ptr8(self.counts)
+        for i in range(6):
+            counts[i] = 0
+
+        # Every other step is a pulse, alternating between the left and right
+        # LEDs.  The sensor outputs are low when they see a reflection.
+        n = int(len(self.ir_pulses.results))
+        i = 0
+        while i < n:
+            side = (i >> 1) & 1
+            pins = int(results[i])
+            if not pins & _LEFT_SENSOR_BIT: counts[_LEFT + side] += 1
+            if not pins & _FRONT_SENSOR_BIT: counts[_FRONT + side] += 1
+            if not pins & _RIGHT_SENSOR_BIT: counts[_RIGHT + side] += 1
+            i += 2
 
     def counts_with_left_leds(self, sensor_number):
-        return self.counts[sensor_number][0]
+        return self.counts[sensor_number * 2]
 
     def counts_with_right_leds(self, sensor_number):
-        return self.counts[sensor_number][1]
+        return self.counts[sensor_number * 2 + 1]
 
     def left_counts_with_left_leds(self):
-        return self.counts_with_left_leds(0)
+        return self.counts[_LEFT]
 
     def left_counts_with_right_leds(self):
-        return self.counts_with_right_leds(0)
+        return self.counts[_LEFT + 1]
 
     def front_counts_with_left_leds(self):
-        return self.counts_with_left_leds(1)
+        return self.counts[_FRONT]
 
     def front_counts_with_right_leds(self):
-        return self.counts_with_right_leds(1)
+        return self.counts[_FRONT + 1]
 
     def right_counts_with_left_leds(self):
-        return self.counts_with_left_leds(2)
+        return self.counts[_RIGHT]
 
     def right_counts_with_right_leds(self):
-        return self.counts_with_right_leds(2)
-
-    def total_counts(self):
-        return sum(self.counts[0]) + sum(self.counts[1]) + sum(self.counts[2])
-
-    def angle_estimate(self):
-        l = sum(self.counts[0])
-        fl = self.counts[1][0]
-        fr = self.counts[1][1]
-        r = sum(self.counts[2])
-        if l + fl + fr + r == 0:
+        return self.counts[_RIGHT + 1]
+
+    @micropython.viper
+    def total_counts(self) -> int:
+        counts = ptr8(self.counts)
+        total = 0
+        for i in range(6):
+            total += counts[i]
+        return total
+
+    @micropython.viper
+    def angle_estimate(self, scale: int) -> int:
+        # Returns the angle to the object in degrees times scale, so
+        # angle_estimate(10) gives tenths of a degree.  (Viper functions do
+        # not support default arguments, so pass 1 for whole degrees.)
+        counts = ptr8(self.counts)
+        l = int(counts[_LEFT]) + int(counts[_LEFT + 1])
+        fl = int(counts[_FRONT])
+        fr = int(counts[_FRONT + 1])
+        r = int(counts[_RIGHT]) + int(counts[_RIGHT + 1])
+        total = l + fl + fr + r
+        if total == 0:
             return 0
 
-        return (-90 * l -20 * fl + 20 * fr + 90 * r) // (l + fl + fr + r)
+        # round towards negative infinity, like Python's //
+        n = (-90 * l -20 * fl + 20 * fr + 90 * r) * scale
+        if n < 0:
+            return -((total - 1 - n) // total)
+        return n // total
+
+    @micropython.viper
+    def proximity_estimate(self) -> int:
+        # Returns how close the object is from 0 (not seen) to 1000 (seen by
+        # every pulse), using the sensor and LEDs that saw it best.  Profiles
+        # with more pulses give finer steps.
+        counts = ptr8(self.counts)
+        best = 0
+        for i in range(6):
+            if int(counts[i]) > best:
+                best = int(counts[i])
+        return best * 1000 // int(self._pulse_count)
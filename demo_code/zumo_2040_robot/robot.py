@@ -6,6 +6,9 @@ from .encoders import Encoders
 from .imu import IMU
 from .ir_sensors import LineSensors
 from .motors import Motors
+from .odometry import Odometry
+from .orientation import OrientationFilter
 from .proximity_sensors import ProximitySensors
 from .rgb_leds import RGBLEDs
+from .speed_controller import SpeedController
 from .yellow_led import YellowLED
@@ -0,0 +1,99 @@
+from array import array
+from machine import Timer, mem32
+from micropython import const
+from .motors import MAX_SPEED, _CH7_CC
+
+DEFAULT_FREQ = const(100)
+
+# The gains are fixed point so the update never allocates floats.
+_GAIN_SHIFT = const(8)
+_INTEGRAL_MAX = const(MAX_SPEED << _GAIN_SHIFT)
+
+class SpeedController:
+    """Drives each motor at a target speed in encoder counts per second
+    using a PI loop run from a timer."""
+    def __init__(self, motors, encoders, freq=DEFAULT_FREQ):
+        self.motors = motors
+        self.encoders = encoders
+        self.freq = freq
+
+        # The motors turn at roughly one count per second for each unit of
+        # speed, so the target is used directly as the feedforward term and
+        # the PI terms correct for battery voltage and motor mismatch.
+        # Gains are in units of 1/256.
+        self.kp = 64
+        self.ki = 512
+
+        self.left_target = 0
+        self.right_target = 0
+        self.left_speed = 0   # measured, counts per second
+        self.right_speed = 0
+        self._left_integral = 0
+        self._right_integral = 0
+        self._speeds = array('i', [0, 0])
+
+        self._timer = None
+        self._callback = self._update # bind once so the timer does not allocate
+
+    def set_gains(self, kp, ki):
+        self.kp = kp
+        self.ki = ki
+
+    def set_speeds(self, left, right):
+        # Targets in encoder counts per second.  Starts the controller if it
+        # is not running.
+        self.left_target = int(left)
+        self.right_target = int(right)
+        if not self._timer:
+            self.start()
+
+    def start(self):
+        self.encoders.read_speeds(self._speeds)
+        self._left_integral = 0
+        self._right_integral = 0
+        self._timer = Timer(freq=self.freq, mode=Timer.PERIODIC,
+                            callback=self._callback)
+
+    def stop(self):
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+        self.left_target = 0
+        self.right_target = 0
+        self.left_speed = 0
+        self.right_speed = 0
+        self.motors.off()
+
+    def _update(self, t):
+        # Speeds timed from the encoder edges, which are much finer than
+        # the change in counts over one update.
+        speeds = self.encoders.read_speeds(self._speeds)
+        self.left_speed = speeds[0]
+        self.right_speed = speeds[1]
+
+        left_out = 0
+        if self.left_target:
+            error = self.left_target - self.left_speed
+            i = self._left_integral + self.ki * error // self.freq
+            if i > _INTEGRAL_MAX: i = _INTEGRAL_MAX
+            if i < -_INTEGRAL_MAX: i = -_INTEGRAL_MAX
+            self._left_integral = i
+            left_out = self.left_target + ((self.kp * error + i) >> _GAIN_SHIFT)
+        else:
+            self._left_integral = 0
+
+        right_out = 0
+        if self.right_target:
+            error = self.right_target - self.right_speed
+            i = self._right_integral + self.ki * error // self.freq
+            if i > _INTEGRAL_MAX: i = _INTEGRAL_MAX
+            if i < -_INTEGRAL_MAX: i = -_INTEGRAL_MAX
+            self._right_integral = i
+            right_out = self.right_target + ((self.kp * error + i) >> _GAIN_SHIFT)
+        else:
+            self._right_integral = 0
+
+        # Write the PWM compare register directly, as Motors.set_speeds does.
+        left_out = self.motors._set_dir_left(left_out)
+        right_out = self.motors._set_dir_right(right_out)
+        mem32[_CH7_CC] = (left_out << 16) | right_out